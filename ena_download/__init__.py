@@ -5,42 +5,102 @@ To use it, you need to provide the accession number of the data you want to down
 __version__ = '0.1.0'
 import requests
 import os
-import subprocess as sp
 import argparse
-from typing import List
+from typing import Callable, List, Iterable, Optional, Iterator, Dict, NamedTuple, Sequence, Union, Tuple
 import sys
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .cache import MetadataCache
+from .report import RunReport, TransferRecord
+from . import metrics
+from . import journal as journal_states
+from .journal import Journal
+from . import workqueue
+from .workqueue import WorkQueue
+from .filecache import FileCache
+from .session import get_session, http_timeout
+from .transfer import (  # noqa: F401 re-exported
+    FastqFile, allocated_bytes, Rate, ChecksumError, PermanentTransferError, TransferCancelled,
+    retry_statuses, is_transient, RetryPolicy, compute_md5, run_with_watchdog, kill_process_group,
+    TransferBackend, AsperaBackend, HttpsBackend, Throttle, backends,
+)
+from .scheduler import TransferScheduler
+from .progress import format_bytes, format_duration, ProgressDisplay, log  # noqa: F401 re-exported
+from .stream import GzipDecompressor, stream_file, stream_data  # noqa: F401 re-exported
+
+run_accession_pattern = re.compile(r"^[EDS]RR[0-9]{6,}$")
+
+accession_pattern = re.compile(
+    r"^("
+    r"[EDS]R[RXSP][0-9]{6,}"      # run, experiment, sample, study
+    r"|SAM[EDN][A-Z]?[0-9]+"      # biosample
+    r"|PRJ[EDN][A-Z][0-9]+"       # project
+    r")$"
+)
 
 def is_valid_accession(accession: str) -> bool:
     """
-    Get the URL of the data to download.
+    Check that an accession number is well formed.
+
+    This is a syntactic check that does not contact the ENA, so typos are
+    rejected straight away. Whether the accession exists is only known once
+    its metadata is requested with :func:`extract_data_path`.
 
     Parameters
     ----------
     accession :
-        The run accession number of the data to download.
+        The run, experiment, sample, study or project accession number.
 
     Returns
     -------
-    str
-        The URL of the data to download.
+    bool
+        True if the accession number is well formed.
 
     Examples
     --------
     >>> is_valid_accession("ERR11466368")
     True
-    >>> is_valid_accession("ERR0000000")
+    >>> is_valid_accession("PRJEB12345")
+    True
+    >>> is_valid_accession("ERR1146636B")
     Traceback (most recent call last):
-    ValueError: Invalid accession number: ERR0000000
+    ValueError: Invalid accession number: ERR1146636B
     """
-    
-    url = f"https://www.ebi.ac.uk/ena/browser/api/xml/{accession}"
-    response = requests.get(url)
-    if response.status_code != 200:
+    if not accession_pattern.match(accession):
         raise ValueError(f"Invalid accession number: {accession}")
     
     return True
 
-def extract_data_path(accession: str) -> List[str]:
+def extract_data_files(accession: str, cache: Optional[MetadataCache] = None) -> List[FastqFile]:
+    """
+    Get the files to download, with their checksums and sizes.
+
+    Parameters
+    ----------
+    accession : str
+        The accession number of the data to download.
+    cache : MetadataCache
+        Cache that is checked before, and filled after, querying the ENA.
+
+    Returns
+    -------
+    List[FastqFile]
+        The files of the data to download.
+
+    Raises
+    ------
+    ValueError
+        If the ENA has no runs for the accession.
+    """
+    records = fetch_filereport(accession, cache)
+    if not records:
+        raise ValueError(f"Invalid accession number: {accession}")
+
+    return [f for record in records for f in record.files]
+
+def extract_data_path(accession: str, cache: Optional[MetadataCache] = None) -> List[str]:
     """
     Get the URL of the data to download.
 
@@ -48,78 +108,656 @@ def extract_data_path(accession: str) -> List[str]:
     ----------
     accession : str
         The accession number of the data to download.
+    cache : MetadataCache
+        Cache that is checked before, and filled after, querying the ENA.
 
     Returns
     -------
     str
         The URLs of the data to download.
 
+    Raises
+    ------
+    ValueError
+        If the ENA has no runs for the accession.
+
     Examples
     --------
     >>> extract_data_path("ERR11466368")
     ['ftp.sra.ebi.ac.uk/vol1/fastq/ERR114/068/ERR11466368/ERR11466368_1.fastq.gz', 'ftp.sra.ebi.ac.uk/vol1/fastq/ERR114/068/ERR11466368/ERR11466368_2.fastq.gz']
     """
     
-    url = f"https://www.ebi.ac.uk/ena/portal/api/filereport?accession={accession}&result=read_run&fields=run_accession,fastq_ftp,fastq_md5,fastq_bytes"
-    response = requests.get(url)
-    if response.status_code != 200:
-        raise ValueError(f"Invalid URL: {url}")
-    
-    second_row = response.text.split("\n")[1]
-    return second_row.split("\t")[1].split(";")
+    return [f.url for f in extract_data_files(accession, cache)]
+
+filereport_fields = "run_accession,fastq_ftp,fastq_md5,fastq_bytes"
+
+unknown_accession_statuses = (204, 400, 404)
+"""HTTP statuses the portal API answers queries for unknown accessions with."""
+
+def _split_list(value: str) -> List[str]:
+    return value.split(";") if value != "" else []
+
+class FilereportRecord(NamedTuple):
+    """
+    The fastq files of one run in a filereport response.
+
+    Attributes
+    ----------
+    run_accession : str
+        The run accession number.
+    urls : Tuple[str, ...]
+        The URLs of the files, without scheme.
+    md5s : Tuple[str, ...]
+        The MD5 checksum of each file, empty if unknown.
+    sizes : Tuple[Optional[int], ...]
+        The size of each file in bytes, None if unknown.
+    """
+    run_accession: str
+    urls: Tuple[str, ...] = ()
+    md5s: Tuple[str, ...] = ()
+    sizes: Tuple[Optional[int], ...] = ()
+
+    @classmethod
+    def from_columns(cls, run_accession: str, fastq_ftp: str = "", fastq_md5: str = "", fastq_bytes: str = "") -> "FilereportRecord":
+        """
+        Build a record from the semicolon separated columns of a filereport row.
+
+        Missing checksums and sizes are padded so there is one for every URL.
+
+        Examples
+        --------
+        >>> FilereportRecord.from_columns("ERR1", "a;b", "x", "1;")
+        FilereportRecord(run_accession='ERR1', urls=('a', 'b'), md5s=('x', ''), sizes=(1, None))
+        """
+        urls = [u for u in _split_list(fastq_ftp) if u != ""]
+        md5s = _split_list(fastq_md5)[:len(urls)]
+        sizes = _split_list(fastq_bytes)[:len(urls)]
+        md5s += [""] * (len(urls) - len(md5s))
+        sizes += [""] * (len(urls) - len(sizes))
+        return cls(
+            run_accession, tuple(urls), tuple(md5s),
+            tuple(int(size) if size.isdigit() else None for size in sizes),
+        )
+
+    @classmethod
+    def from_row(cls, row: Dict[str, str]) -> "FilereportRecord":
+        """Build a record from a row as stored in the :class:`MetadataCache`."""
+        return cls.from_columns(
+            row["run_accession"], row.get("fastq_ftp", ""), row.get("fastq_md5", ""), row.get("fastq_bytes", ""),
+        )
 
-import signal, os
+    @property
+    def files(self) -> List[FastqFile]:
+        """The files of the run."""
+        return [FastqFile(*f) for f in zip(self.urls, self.md5s, self.sizes)]
 
-def handler(signum, frame):
-    """Signal handler for the download timeout."""
-    raise TimeoutError(f'Download timeout reached, trying again!')
+    def to_row(self) -> Dict[str, str]:
+        """
+        Get the record as a filereport row, as stored in the :class:`MetadataCache`.
 
-def download_data(accession: str, urls: List[str],timeout: int = 300) -> None:
+        Examples
+        --------
+        >>> FilereportRecord.from_columns("ERR1", "a;b", "x;y", "1;2").to_row()
+        {'run_accession': 'ERR1', 'fastq_ftp': 'a;b', 'fastq_md5': 'x;y', 'fastq_bytes': '1;2'}
+        """
+        return {
+            "run_accession": self.run_accession,
+            "fastq_ftp": ";".join(self.urls),
+            "fastq_md5": ";".join(self.md5s),
+            "fastq_bytes": ";".join("" if size is None else str(size) for size in self.sizes),
+        }
+
+def iter_records(lines: Iterable[str]) -> Iterator[FilereportRecord]:
+    """
+    Parse the lines of a filereport response into records, one row at a time.
+
+    The columns are found by their names in the header line, so their
+    order does not matter and missing or empty columns are treated as
+    empty. Blank lines and empty responses yield nothing. Only the current
+    row is held in memory, so a response can be parsed straight from
+    ``response.iter_lines()``.
+
+    Parameters
+    ----------
+    lines : Iterable[str]
+        The lines of the response, starting with the header line.
+
+    Yields
+    ------
+    FilereportRecord
+        One record per run.
+
+    Raises
+    ------
+    ValueError
+        If the header has no ``run_accession`` column.
+
+    Examples
+    --------
+    >>> lines = ["fastq_md5\\trun_accession\\tfastq_ftp", "x;y\\tERR1\\ta;b\\r", "\\tERR2\\t", ""]
+    >>> for record in iter_records(lines):
+    ...     print(record.run_accession, record.files)
+    ERR1 [FastqFile(url='a', md5='x', bytes=None), FastqFile(url='b', md5='y', bytes=None)]
+    ERR2 []
+    >>> list(iter_records([]))
+    []
+    """
+    columns: Optional[List[int]] = None
+    for line in lines:
+        if line.strip() == "":
+            continue
+        values = line.rstrip("\r\n").split("\t")
+        if columns is None:
+            if "run_accession" not in values:
+                raise ValueError(f"Filereport header has no run_accession column: {line.strip()}")
+            # Position of each field in the row, or -1 if the response lacks it
+            columns = [values.index(field) if field in values else -1 for field in filereport_fields.split(",")]
+            continue
+        yield FilereportRecord.from_columns(*(values[c] if 0 <= c < len(values) else "" for c in columns))
+
+def records_to_files(records: Iterable[FilereportRecord]) -> Dict[str, List[FastqFile]]:
+    """
+    Collect the fastq files of each run from filereport records.
+
+    Parameters
+    ----------
+    records : Iterable[FilereportRecord]
+        Records as returned by :func:`iter_records`.
+
+    Returns
+    -------
+    Dict[str, List[FastqFile]]
+        The files of the data to download, keyed by run accession.
+    """
+    return {record.run_accession: record.files for record in records}
+
+def fetch_filereport(accession: str, cache: Optional[MetadataCache] = None) -> List[FilereportRecord]:
+    """
+    Get the filereport records of all runs belonging to an accession.
+
+    Parameters
+    ----------
+    accession : str
+        A run, experiment, sample, study or project accession number.
+    cache : MetadataCache
+        Cache that is checked before, and filled after, querying the ENA.
+
+    Returns
+    -------
+    List[FilereportRecord]
+        One record per run. The list is empty if the accession is not known to the ENA.
+
+    Raises
+    ------
+    requests.HTTPError
+        If the portal answers with an error other than those for unknown accessions.
+    """
+    return [record for page in iter_filereport_pages(accession, cache) for record in page]
+
+def iter_filereport_pages(accession: str, cache: Optional[MetadataCache] = None, page_size: int = 1000) -> Iterator[List[FilereportRecord]]:
+    """
+    Get the filereport records of all runs belonging to an accession, a page at a time.
+
+    The response is parsed while it is being received, so the records of a
+    project with tens of thousands of runs are never all held in memory, and
+    each page is stored in the cache as soon as it is complete. The list of
+    runs an accession expands into is only cached once the whole response
+    has been read.
+
+    Parameters
+    ----------
+    accession : str
+        A run, experiment, sample, study or project accession number.
+    cache : MetadataCache
+        Cache that is checked before, and filled after, querying the ENA.
+    page_size : int
+        The maximum number of records in a page. Default is 1000.
+
+    Yields
+    ------
+    List[FilereportRecord]
+        Up to ``page_size`` records, one per run. Nothing is yielded if the
+        accession is not known to the ENA.
+
+    Raises
+    ------
+    requests.HTTPError
+        If the portal answers with an error status other than those in
+        :data:`unknown_accession_statuses`, e.g. when it is overloaded.
+    """
+    if cache is not None:
+        if run_accession_pattern.match(accession):
+            runs: Optional[List[str]] = [accession]
+        else:
+            runs = cache.get_expansion(accession)
+        if runs:
+            cached = cache.get_rows(runs)
+            if len(cached) == len(runs):
+                for i in range(0, len(runs), page_size):
+                    yield [FilereportRecord.from_row(cached[r]) for r in runs[i:i + page_size]]
+                return
+
+    url = f"https://www.ebi.ac.uk/ena/portal/api/filereport?accession={accession}&result=read_run&fields={filereport_fields}"
+    start = time.monotonic()
+    expansion = []
+    with get_session().get(url, timeout=http_timeout, stream=True) as response:
+        metrics.observe_metadata_query(time.monotonic() - start)
+        # The portal answers unknown accessions with an empty report or one of
+        # a few client errors; any other error must not pass for an unknown accession
+        if response.status_code in unknown_accession_statuses:
+            return
+        response.raise_for_status()
+        page = []
+        for record in iter_records(response.iter_lines(decode_unicode=True)):
+            page.append(record)
+            if len(page) == page_size:
+                if cache is not None:
+                    expansion += [r.run_accession for r in page]
+                    cache.put_rows(r.to_row() for r in page)
+                yield page
+                page = []
+        if page:
+            if cache is not None:
+                expansion += [r.run_accession for r in page]
+                cache.put_rows(r.to_row() for r in page)
+            yield page
+
+    if cache is not None and expansion and not run_accession_pattern.match(accession):
+        cache.put_expansion(accession, expansion)
+
+def resolve_accessions(accessions: Iterable[str], chunk_size: int = 500, cache: Optional[MetadataCache] = None, errors: Optional[Dict[str, Exception]] = None) -> Dict[str, List[FastqFile]]:
+    """
+    Get the files to download for many accessions at once.
+
+    Run accessions are looked up in chunks of ``chunk_size`` with a single
+    query to the portal search API per chunk. Any other accession (study,
+    sample, experiment or project) is expanded into all of its runs with a
+    filereport query. A query that fails does not stop the others.
+
+    Parameters
+    ----------
+    accessions : Iterable[str]
+        The accession numbers to resolve.
+    chunk_size : int
+        The maximum number of run accessions sent in one query. Default is 500.
+    cache : MetadataCache
+        Cache that is checked before, and filled after, querying the ENA.
+        Only the accessions missing from the cache are queried.
+    errors : Dict[str, Exception]
+        Filled with the accessions of every failed query and its error.
+
+    Returns
+    -------
+    Dict[str, List[FastqFile]]
+        The files of the data to download, keyed by run accession. Accessions
+        that are not known to the ENA, or whose query failed, contribute no
+        runs to the result.
+    """
+    unique_accessions = list(dict.fromkeys(accessions))
+    runs = [a for a in unique_accessions if run_accession_pattern.match(a)]
+    others = [a for a in unique_accessions if not run_accession_pattern.match(a)]
+
+    files: Dict[str, List[FastqFile]] = {}
+    if cache is not None:
+        cached = cache.get_rows(runs)
+        files.update(records_to_files(FilereportRecord.from_row(row) for row in cached.values()))
+        runs = [r for r in runs if r not in cached]
+
+    for i in range(0, len(runs), chunk_size):
+        chunk = runs[i:i + chunk_size]
+        url = "https://www.ebi.ac.uk/ena/portal/api/search"
+        start = time.monotonic()
+        try:
+            with get_session().post(url, timeout=http_timeout, stream=True, data={
+                "result": "read_run",
+                "includeAccessions": ",".join(chunk),
+                "fields": filereport_fields,
+                "format": "tsv",
+                "limit": 0,
+            }) as response:
+                metrics.observe_metadata_query(time.monotonic() - start)
+                response.raise_for_status()
+                records = list(iter_records(response.iter_lines(decode_unicode=True)))
+        except (requests.RequestException, ValueError) as e:
+            sys.stderr.write(f"Failed to resolve {len(chunk)} accessions: {e}\n")
+            if errors is not None:
+                errors.update((a, e) for a in chunk)
+            continue
+        if cache is not None:
+            cache.put_rows(r.to_row() for r in records)
+        files.update(records_to_files(records))
+
+    for accession in others:
+        # Unknown accessions are left out of the result rather than failing the batch
+        try:
+            for page in iter_filereport_pages(accession, cache):
+                files.update(records_to_files(page))
+        except (requests.RequestException, ValueError) as e:
+            sys.stderr.write(f"Failed to resolve {accession}: {e}\n")
+            if errors is not None:
+                errors[accession] = e
+
+    return files
+
+def parse_rate(rate: str) -> int:
+    """
+    Convert a transfer rate such as ``300m`` or ``1g`` to kilobits per second.
+
+    Parameters
+    ----------
+    rate : str
+        The rate as a number with an optional ``k``, ``m`` or ``g`` suffix.
+        A number without suffix is taken to be in kilobits per second, as in ``ascp -l``.
+
+    Returns
+    -------
+    int
+        The rate in kilobits per second.
+
+    Examples
+    --------
+    >>> parse_rate("300m")
+    300000
+    >>> parse_rate("1.5G")
+    1500000
+    >>> parse_rate("800")
+    800
+    >>> parse_rate("fast")
+    Traceback (most recent call last):
+    ValueError: Invalid rate: fast
+    """
+    multipliers = {'k': 1, 'm': 1000, 'g': 1000000}
+    value = rate.strip().lower()
+    multiplier = 1
+    if value and value[-1] in multipliers:
+        multiplier = multipliers[value[-1]]
+        value = value[:-1]
+    try:
+        kbps = int(float(value) * multiplier)
+    except ValueError:
+        raise ValueError(f"Invalid rate: {rate}")
+    if kbps < 1:
+        raise ValueError(f"Invalid rate: {rate}")
+    return kbps
+
+def parse_size(size: str) -> int:
+    """
+    Convert a size such as ``500g`` or ``2t`` to bytes.
+
+    Parameters
+    ----------
+    size : str
+        The size as a number with an optional ``k``, ``m``, ``g`` or ``t``
+        suffix for powers of 1024. A number without suffix is in bytes.
+
+    Returns
+    -------
+    int
+        The size in bytes.
+
+    Examples
+    --------
+    >>> parse_size("2t")
+    2199023255552
+    >>> parse_size("1.5G")
+    1610612736
+    >>> parse_size("big")
+    Traceback (most recent call last):
+    ValueError: Invalid size: big
+    """
+    multipliers = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+    value = size.strip().lower()
+    multiplier = 1
+    if value and value[-1] in multipliers:
+        multiplier = multipliers[value[-1]]
+        value = value[:-1]
+    try:
+        n = int(float(value) * multiplier)
+    except ValueError:
+        raise ValueError(f"Invalid size: {size}")
+    if n < 0:
+        raise ValueError(f"Invalid size: {size}")
+    return n
+
+def is_complete(filename: str, fastq_file: FastqFile) -> bool:
+    """
+    Check whether a file on disk matches the size and checksum listed by the ENA.
+
+    A file whose size is larger than expected, or whose checksum does not
+    match, cannot be resumed and is removed.
+
+    Parameters
+    ----------
+    filename : str
+        The local path of the file.
+    fastq_file : FastqFile
+        The file as listed by the ENA.
+
+    Returns
+    -------
+    bool
+        True if the file is already complete. Files with neither a known size
+        nor a known checksum are never considered complete.
+    """
+    if not os.path.exists(filename):
+        return False
+    if fastq_file.bytes is None and fastq_file.md5 == "":
+        return False
+
+    size = os.path.getsize(filename)
+    if fastq_file.bytes is not None and size < fastq_file.bytes:
+        # A partial file that ascp can resume
+        return False
+    if (fastq_file.bytes is not None and size > fastq_file.bytes) or \
+            (fastq_file.md5 != "" and compute_md5(filename) != fastq_file.md5):
+        log(f"Removing corrupt file {filename}")
+        os.remove(filename)
+        return False
+    return True
+
+def download_file(url: Union[str, FastqFile], accession: str, timeout: int = 300, scheduler: Optional[TransferScheduler] = None, backend: Optional[TransferBackend] = None, report: Optional[RunReport] = None, journal: Optional[Journal] = None, retry: Optional[RetryPolicy] = None, file_cache: Optional[FileCache] = None, cancel: Optional[threading.Event] = None) -> None:
+    """
+    Download a single file from the ENA, retrying on failure.
+
+    Files that are already on disk with the expected size and checksum are
+    skipped, and files in ``file_cache`` are linked into place. Partially
+    downloaded files are resumed by the backend. After the transfer the
+    checksum is verified, and the file is downloaded again if it does not
+    match.
+
+    Parameters
+    ----------
+    url : str or FastqFile
+        The URL of the file to download, or the file as listed by the ENA.
+    accession : str
+        The accession number of the data, used as the output directory.
+    timeout : int
+        Seconds without progress after which a transfer is stopped and retried. Default is 300 seconds.
+    scheduler : TransferScheduler
+        Scheduler that hands out transfer slots and rates. Each attempt
+        acquires a new slot, so a retry picks up the current share of the budget.
+    backend : TransferBackend
+        The method used to transfer the file. Default is :class:`AsperaBackend`.
+    report : RunReport
+        Report that a :class:`TransferRecord` of the transfer is added to.
+    journal : Journal
+        Journal the state of the file is recorded in. A file the journal
+        already has as complete is skipped without checksumming it again,
+        provided it is still on disk with the expected size.
+    retry : RetryPolicy
+        How often to retry transient failures and how long to back off in
+        between. Default is 3 attempts.
+    file_cache : FileCache
+        Shared cache that a file with a known checksum is taken from instead
+        of downloading it, and that verified downloads are added to.
+    cancel : threading.Event
+        Event that stops the transfer, and any further attempts, when it is set.
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    TimeoutError
+        If every attempt failed with a transient error.
+    TransferCancelled
+        If ``cancel`` was set before the file was downloaded.
+    Exception
+        The error of the first attempt that failed permanently, e.g. a
+        :class:`PermanentTransferError` or an HTTP 404.
+    """
+    fastq_file = url if isinstance(url, FastqFile) else FastqFile(url)
+    filename = os.path.join(accession, fastq_file.filename)
+    if scheduler is None:
+        scheduler = TransferScheduler()
+    if backend is None:
+        backend = AsperaBackend()
+    if retry is None:
+        retry = RetryPolicy()
+    if retry.attempts < 1:
+        raise ValueError(f"Number of attempts must be at least 1, got {retry.attempts}")
+
+    def record(status: str, attempts: int, error: str = "") -> None:
+        metrics.count_file(status)
+        if report is None:
+            return
+        transferred = allocated_bytes([filename, filename + '.part']) if status == "failed" else os.path.getsize(filename)
+        report.add(TransferRecord(
+            accession, fastq_file.url, status, max(transferred - start_bytes, 0),
+            time.monotonic() - start, attempts, backend.name, backend.endpoint, error,
+        ))
+
+    def set_state(state: str) -> None:
+        if journal is not None:
+            journal.set_state(accession, fastq_file.url, state)
+
+    start = time.monotonic()
+    journaled = journal.state(accession, fastq_file.url) if journal is not None else None
+    complete_in_journal = journaled == journal_states.VERIFIED or \
+        (journaled == journal_states.DOWNLOADED and fastq_file.md5 == "")
+    if complete_in_journal and os.path.exists(filename) and \
+            fastq_file.bytes in (None, os.path.getsize(filename)):
+        log(f"Skipping {fastq_file.url}, already downloaded", progress=True)
+        start_bytes = os.path.getsize(filename)
+        record("skipped", 0)
+        return None
+    if is_complete(filename, fastq_file):
+        log(f"Skipping {fastq_file.url}, already downloaded", progress=True)
+        start_bytes = os.path.getsize(filename)
+        set_state(journal_states.VERIFIED if fastq_file.md5 != "" else journal_states.DOWNLOADED)
+        record("skipped", 0)
+        return None
+    if file_cache is not None and fastq_file.md5 != "" and file_cache.get(fastq_file.md5, filename):
+        log(f"Using cached copy of {fastq_file.url}", progress=True)
+        start_bytes = os.path.getsize(filename)
+        set_state(journal_states.VERIFIED)
+        record("cached", 0)
+        return None
+    start_bytes = os.path.getsize(filename) if os.path.exists(filename) else allocated_bytes([filename + '.part'])
+
+    for i in range(retry.attempts):
+        log(f"Attempt {i+1} at downloading {fastq_file.url}...", progress=True)
+        try:
+            if cancel is not None and cancel.is_set():
+                raise TransferCancelled(f"Transfer of {fastq_file.url} cancelled")
+            with scheduler.slot([filename, filename + '.partial', filename + '.part'], fastq_file.bytes) as rate:
+                # The batch may have been cancelled while waiting for the slot
+                if cancel is not None and cancel.is_set():
+                    raise TransferCancelled(f"Transfer of {fastq_file.url} cancelled")
+                set_state(journal_states.TRANSFERRING)
+                if rate is not None and backend.live_rate:
+                    backend.transfer(fastq_file, filename, scheduler.live_rate(), timeout, cancel=cancel)
+                else:
+                    backend.transfer(fastq_file, filename, rate, timeout, cancel=cancel)
+            set_state(journal_states.DOWNLOADED)
+            # The transfer slot is released before verifying so the next
+            # transfer can start while this file is being checksummed
+            if fastq_file.md5 != "":
+                if not scheduler.verify(filename, fastq_file.md5):
+                    log(f"Checksum mismatch for {filename}, downloading again")
+                    os.remove(filename)
+                    raise ChecksumError(f"Checksum mismatch for {filename}")
+                set_state(journal_states.VERIFIED)
+                if file_cache is not None:
+                    try:
+                        file_cache.put(fastq_file.md5, filename)
+                    except OSError as e:
+                        log(f"Could not add {filename} to the file cache: {e}")
+            record("ok", i + 1)
+            return None
+        except Exception as e:
+            error = e
+            if not is_transient(e):
+                log(f"Not retrying {fastq_file.url}: {e!r}")
+                break
+            if i + 1 < retry.attempts:
+                metrics.count_retry()
+                # Back off without holding a transfer slot
+                if cancel is not None:
+                    cancel.wait(retry.delay(i))
+                else:
+                    time.sleep(retry.delay(i))
+    set_state(journal_states.FAILED)
+    record("failed", i + 1, repr(error))
+    if not is_transient(error):
+        raise error
+    raise TimeoutError(f"Download failed after {retry.attempts} attempts: {error!r}") from error
+
+def download_data(accession: str, urls: Sequence[Union[str, FastqFile]],timeout: int = 300, scheduler: Optional[TransferScheduler] = None, backend: Optional[TransferBackend] = None, report: Optional[RunReport] = None, journal: Optional[Journal] = None, retry: Optional[RetryPolicy] = None, file_cache: Optional[FileCache] = None, cancel: Optional[threading.Event] = None) -> None:
     """
     Download data from the ENA.
 
+    The files of the run are transferred concurrently, subject to the
+    number of transfer slots available in ``scheduler``. Files that are
+    already complete on disk are skipped.
+
     Parameters
     ----------
     accession : str
         The accession number of the data to download.
-    urls : str
-        The URLs of the data to download.
+    urls : list of str or FastqFile
+        The URLs of the data to download, or the files as returned by
+        :func:`extract_data_files`. Sizes and checksums are only checked for
+        ``FastqFile`` entries.
     timeout : int
-        The timeout in seconds for the download to complete. Default is 300 seconds.
+        Seconds without progress after which a transfer is stopped and retried. Default is 300 seconds.
+    scheduler : TransferScheduler
+        Scheduler shared between downloads to cap the number of concurrent
+        transfers and their bandwidth. A new scheduler with the default
+        limits is used if not given.
+    backend : TransferBackend
+        The method used to transfer the files. Default is :class:`AsperaBackend`.
+    report : RunReport
+        Report that the metrics of every transfer are added to.
+    journal : Journal
+        Journal the state of every file is recorded in.
+    retry : RetryPolicy
+        How often to retry transient failures of each file. Default is 3 attempts.
+    file_cache : FileCache
+        Shared cache that files are taken from and added to.
+    cancel : threading.Event
+        Event that stops the transfers of the run when set.
 
     Returns
     -------
     None
     """
-    if not os.path.exists(accession):
-        os.mkdir(accession)
+    os.makedirs(accession, exist_ok=True)
 
-    home = os.path.expanduser("~")
-    ascp = os.path.join(home, '.aspera/cli/bin/ascp')
-    opensshfile = os.path.join(home, '.aspera/cli/etc/asperaweb_id_dsa.openssh')
+    if scheduler is None:
+        scheduler = TransferScheduler()
 
-    for url in urls:
-        i=0
-        while True:
-            sys.stderr.write(f"Attempt {i+1} at downloading {url}...\n")
-            signal.signal(signal.SIGALRM, handler)
-            signal.alarm(timeout)
-            try:
-                path = url.replace('ftp.sra.ebi.ac.uk/', 'era-fasp@fasp.sra.ebi.ac.uk:')
-                sp.run([
-                    ascp, '-T', '-l', '300m', '-P', '33001', '-i', opensshfile, 
-                    path, accession + '/'
-                ], check=True)
-                signal.alarm(0)
-                break
-            except:
-                i+=1
-                if i==3:
-                    raise TimeoutError(f"Download failed after 3 attempts")
-                continue
+    with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+        futures = [executor.submit(download_file, url, accession, timeout, scheduler, backend, report, journal, retry, file_cache, cancel) for url in urls]
+        # Wait for every file before reporting the first failure
+        errors = [f.exception() for f in futures]
+    for error in errors:
+        if error is not None:
+            raise error
     return None
 
-def main(accession: str, timeout: int = 300) -> None:
+def main(accession: str, timeout: int = 300, scheduler: Optional[TransferScheduler] = None, cache: Optional[MetadataCache] = None, backend: Optional[TransferBackend] = None) -> None:
     """
     Function that calls all the other functions to download data from the ENA.
 
@@ -128,7 +766,13 @@ def main(accession: str, timeout: int = 300) -> None:
     accession : str
         The accession number of the data to download.
     timeout : int
-        The timeout in seconds for the download to complete. Default is 300 seconds.
+        Seconds without progress after which a transfer is stopped and retried. Default is 300 seconds.
+    scheduler : TransferScheduler
+        Scheduler used to cap the number of concurrent transfers.
+    cache : MetadataCache
+        Cache for the metadata of the accession.
+    backend : TransferBackend
+        The method used to transfer the files. Default is :class:`AsperaBackend`.
 
     Returns
     -------
@@ -137,26 +781,662 @@ def main(accession: str, timeout: int = 300) -> None:
     
     is_valid_accession(accession)
     
-    paths = extract_data_path(accession)
+    files = extract_data_files(accession, cache)
 
-    download_data(accession, paths, timeout)
+    download_data(accession, files, timeout, scheduler, backend)
 
     
     return None
 
+def order_largest_first(files: Dict[str, List[FastqFile]]) -> List[str]:
+    """
+    Order runs by their total size, largest first.
+
+    Starting the largest runs first keeps a single big transfer from running
+    alone at the end of a batch. Runs of unknown size are put last.
+
+    Parameters
+    ----------
+    files : Dict[str, List[FastqFile]]
+        The files of each run, as returned by :func:`resolve_accessions`.
+
+    Returns
+    -------
+    List[str]
+        The run accessions in the order they should be downloaded.
+
+    Examples
+    --------
+    >>> order_largest_first({
+    ...     "ERR1": [FastqFile("a", bytes=200)],
+    ...     "ERR2": [FastqFile("b", bytes=400), FastqFile("c", bytes=400)],
+    ...     "ERR3": [FastqFile("d")],
+    ... })
+    ['ERR2', 'ERR1', 'ERR3']
+    """
+    def total_size(run: str) -> int:
+        sizes = [f.bytes for f in files[run]]
+        if not sizes or None in sizes:
+            return -1
+        return sum(s for s in sizes if s is not None)
+    return sorted(files, key=total_size, reverse=True)
+
+def read_accession_file(filename: str) -> List[str]:
+    """
+    Read accession numbers from a file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to a file with one accession number per line. Blank lines and
+        lines starting with ``#`` are ignored.
+
+    Returns
+    -------
+    List[str]
+        The accession numbers in the order they appear in the file.
+    """
+    accessions = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            accessions.append(line.split()[0])
+    return accessions
+
+def resolve_batch(accessions: Sequence[str], cache: Optional[MetadataCache] = None, journal: Optional[Journal] = None, on_files: Optional[Callable[[Dict[str, List[FastqFile]]], None]] = None) -> Tuple[Dict[str, List[FastqFile]], List[str]]:
+    """
+    Resolve the accessions of a batch into the files of their runs.
+
+    Run accessions are resolved with as few metadata queries as possible (see
+    :func:`resolve_accessions`) and other accessions are expanded into all
+    of their runs. Accessions the journal already has resolved are not
+    queried again.
+
+    Parameters
+    ----------
+    accessions : Sequence[str]
+        The accession numbers, without duplicates.
+    cache : MetadataCache
+        Cache for the metadata of the accessions.
+    journal : Journal
+        Journal the resolved runs are recorded in.
+    on_files : callable
+        Called with the files of each batch of runs as soon as they are
+        resolved, e.g. to start queueing the runs of a large project while
+        the rest of it is still being fetched.
+
+    Returns
+    -------
+    Tuple[Dict[str, List[FastqFile]], List[str]]
+        The files of each run, and the accessions that are malformed, that
+        the ENA has no runs for, or whose metadata could not be fetched,
+        followed by the runs without fastq files.
+    """
+    well_formed = [a for a in accessions if accession_pattern.match(a)]
+
+    files: Dict[str, List[FastqFile]] = {}
+
+    def add(page: Dict[str, List[FastqFile]]) -> None:
+        files.update(page)
+        if on_files is not None and page:
+            on_files(page)
+
+    # Take what the journal already resolved and only query the rest; an
+    # accession without runs is queried again so that it is reported
+    unresolved = []
+    for accession in well_formed:
+        if journal is not None and journal.resolved.get(accession):
+            add({run: [FastqFile(**f) for f in journal.files.get(run, [])] for run in journal.resolved[accession]})
+        else:
+            unresolved.append(accession)
+
+    errors: Dict[str, Exception] = {}
+    resolved_runs = resolve_accessions([a for a in unresolved if run_accession_pattern.match(a)], cache=cache, errors=errors)
+    add(resolved_runs)
+    expansions = {a: [a] for a in resolved_runs}
+    for accession in unresolved:
+        if not run_accession_pattern.match(accession):
+            expansions[accession] = []
+            try:
+                for page in iter_filereport_pages(accession, cache):
+                    expanded = records_to_files(page)
+                    add(expanded)
+                    expansions[accession] += expanded
+            except (requests.RequestException, ValueError) as e:
+                errors[accession] = e
+    if journal is not None:
+        for accession, runs in expansions.items():
+            # A failed expansion may be incomplete and is queried again on resume
+            if not runs or accession in errors:
+                continue
+            journal.record_resolved(accession, {run: [f._asdict() for f in files[run]] for run in runs})
+
+    well_formed_set = set(well_formed)
+    unresolved_set = set(unresolved)
+    invalid = []
+    for accession in accessions:
+        # Malformed accessions are rejected without a query, and well formed
+        # ones are invalid if the portal returned no run for them
+        if accession in errors:
+            sys.stderr.write(f"Failed to download {accession}: {errors[accession]}\n")
+            invalid.append(accession)
+        elif accession not in well_formed_set or (accession in unresolved_set and not expansions.get(accession)):
+            sys.stderr.write(f"Failed to download {accession}: Invalid accession number: {accession}\n")
+            invalid.append(accession)
+    # Runs with only submitted files have nothing to download
+    for run in [r for r, run_files in files.items() if not run_files]:
+        sys.stderr.write(f"Failed to download {run}: No fastq files for {run}\n")
+        invalid.append(run)
+        del files[run]
+    return files, invalid
+
+def main_many(accessions: Iterable[str], timeout: int = 300, jobs: int = 1, transfers: int = 2, max_rate: Optional[int] = None, cache: Optional[MetadataCache] = None, backend: Optional[TransferBackend] = None, adaptive: bool = False, report: Optional[RunReport] = None, progress: bool = False, journal: Optional[Journal] = None, retry: Optional[RetryPolicy] = None, file_cache: Optional[FileCache] = None) -> List[str]:
+    """
+    Download data for many accessions from a single process.
+
+    The accessions are first resolved into runs with as few metadata
+    queries as possible (see :func:`resolve_accessions`). The runs are then
+    scheduled largest first through a bounded pool of worker threads so that
+    up to ``jobs`` of them are processed at the same time. A failure for one run
+    is reported and does not stop the others. On a keyboard interrupt the
+    runs that have not started are dropped and the running transfers are
+    stopped before the interrupt is raised again.
+
+    Parameters
+    ----------
+    accessions : Iterable[str]
+        The accession numbers of the data to download. Study, sample,
+        experiment and project accessions are expanded into their runs.
+        Duplicates are only downloaded once.
+    timeout : int
+        Seconds without progress after which a transfer is stopped and retried. Default is 300 seconds.
+    jobs : int
+        The number of accessions to process concurrently. Default is 1.
+    transfers : int
+        The maximum number of files transferred at the same time across all
+        accessions. Default is 2.
+    max_rate : int
+        The total bandwidth in kilobits per second shared by all transfers.
+        If not given, each transfer runs at the backend's default rate.
+    cache : MetadataCache
+        Cache for the metadata of the accessions.
+    backend : TransferBackend
+        The method used to transfer the files. Default is :class:`AsperaBackend`.
+    adaptive : bool
+        Tune the number of concurrent transfers, up to ``transfers``, from the
+        observed throughput. Default is False.
+    report : RunReport
+        Report that the metrics of every transfer are added to.
+    progress : bool
+        Show the aggregated progress of all files on stderr. Default is False.
+    journal : Journal
+        Journal the resolved runs and the state of every file are recorded
+        in. Accessions the journal already has resolved are not queried
+        again, and files it has as complete are skipped.
+    retry : RetryPolicy
+        How often to retry transient failures of each file. Default is 3 attempts.
+    file_cache : FileCache
+        Shared cache that files are taken from and added to.
+
+    Returns
+    -------
+    List[str]
+        The accession numbers that could not be resolved and the runs that
+        could not be downloaded.
+    """
+    if jobs < 1:
+        raise ValueError(f"Number of jobs must be at least 1, got {jobs}")
+
+    scheduler = TransferScheduler(transfers, max_rate, adaptive=adaptive)
+    metrics.register_scheduler(scheduler)
+    unique_accessions = list(dict.fromkeys(accessions))
+    files, invalid = resolve_batch(unique_accessions, cache, journal)
+    failed = set(invalid)
+
+    display = ProgressDisplay(files) if progress else None
+    if display is not None:
+        display.start()
+    cancel = threading.Event()
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(download_data, run, files[run], timeout, scheduler, backend, report, journal, retry, file_cache, cancel): run
+                for run in order_largest_first(files)
+            }
+            try:
+                for future in as_completed(futures):
+                    run = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        log(f"Failed to download {run}: {e}")
+                        failed.add(run)
+            except KeyboardInterrupt:
+                # Leaving the executor waits for the running downloads, so
+                # stop them rather than letting the batch carry on
+                for future in futures:
+                    future.cancel()
+                cancel.set()
+                raise
+    finally:
+        if display is not None:
+            display.stop()
+        scheduler.close()
+
+    # Report failures in the order the accessions were given
+    requested = set(unique_accessions)
+    ordered = unique_accessions + [r for r in invalid + list(files) if r not in requested]
+    return [a for a in ordered if a in failed]
+
+def main_stream(accessions: Iterable[str], target: Union[str, Callable[[str, FastqFile, bytes], None]], decompress: bool = False, cache: Optional[MetadataCache] = None, backend: Optional[HttpsBackend] = None, timeout: int = 300, retry: Optional[RetryPolicy] = None, max_rate: Optional[int] = None) -> List[str]:
+    """
+    Stream the data of many accessions into a pipeline, one run at a time.
+
+    Parameters
+    ----------
+    accessions : Iterable[str]
+        The accession numbers of the data. Study, sample, experiment and
+        project accessions are expanded into their runs.
+    target : str or callable
+        Where the data goes, see :func:`stream_data`.
+    decompress : bool
+        Deliver the decompressed contents of the files. Default is False.
+    cache : MetadataCache
+        Cache for the metadata of the accessions.
+    backend : HttpsBackend
+        The backend the files are fetched with. Default is :class:`HttpsBackend`.
+    timeout : int
+        Seconds without data after which a connection is dropped and resumed. Default is 300 seconds.
+    retry : RetryPolicy
+        How often to resume after transient failures. Default is 3 attempts.
+    max_rate : int
+        The bandwidth in kilobits per second shared by the files of a run,
+        or None for no limit.
+
+    Returns
+    -------
+    List[str]
+        The accession numbers that could not be resolved and the runs that
+        could not be streamed.
+    """
+    unique_accessions = list(dict.fromkeys(accessions))
+    files, failed = resolve_batch(unique_accessions, cache)
+    for run, run_files in files.items():
+        try:
+            stream_data(run, run_files, target, decompress, backend, timeout, retry, max_rate)
+        except BrokenPipeError:
+            # The reader went away, so there is nowhere left to stream to
+            raise
+        except Exception as e:
+            sys.stderr.write(f"Failed to stream {run}: {e}\n")
+            failed.append(run)
+    return failed
+
+def serve_queue(accessions: Iterable[str], queue: WorkQueue, cache: Optional[MetadataCache] = None, wait: bool = True, interval: float = 30.0) -> List[str]:
+    """
+    Resolve a batch into per-file tasks on a shared queue and wait for workers to finish it.
+
+    The files are downloaded by :func:`run_worker` processes on any number
+    of hosts that share the queue database and the output directory.
+
+    Parameters
+    ----------
+    accessions : Iterable[str]
+        The accession numbers of the data to download. Study, sample,
+        experiment and project accessions are expanded into their runs.
+    queue : WorkQueue
+        The queue the files are added to.
+    cache : MetadataCache
+        Cache for the metadata of the accessions.
+    wait : bool
+        Wait until every task is done or failed, reporting the progress on
+        stderr. Default is True.
+    interval : float
+        Seconds between progress reports. Default is 30 seconds.
+
+    Returns
+    -------
+    List[str]
+        The accession numbers that could not be resolved and, if ``wait`` is
+        True, the runs with files that could not be downloaded.
+    """
+    unique_accessions = list(dict.fromkeys(accessions))
+    added = 0
+
+    def enqueue(page: Dict[str, List[FastqFile]]) -> None:
+        nonlocal added
+        added += queue.add({run: [f._asdict() for f in run_files] for run, run_files in page.items()})
+
+    # Workers can start on the first runs of a large project while the rest is being resolved
+    files, invalid = resolve_batch(unique_accessions, cache, on_files=enqueue)
+    sys.stderr.write(f"Queued {added} new files of {len(files)} runs in {queue.path}\n")
+    if not wait:
+        return invalid
+
+    while True:
+        queue.expire()
+        counts = queue.counts()
+        sys.stderr.write(", ".join(f"{n} {state}" for state, n in counts.items()) + "\n")
+        if counts[workqueue.PENDING] + counts[workqueue.LEASED] == 0:
+            break
+        time.sleep(interval)
+    failed_runs = set()
+    for task, error in queue.failures():
+        sys.stderr.write(f"Failed to download {task.url}: {error}\n")
+        failed_runs.add(task.run)
+    return invalid + [run for run in files if run in failed_runs]
+
+def run_worker(queue: WorkQueue, timeout: int = 300, transfers: int = 2, max_rate: Optional[int] = None, backend: Optional[TransferBackend] = None, report: Optional[RunReport] = None, retry: Optional[RetryPolicy] = None, wait: bool = False, poll_interval: float = 10.0, file_cache: Optional[FileCache] = None) -> int:
+    """
+    Download files leased from a shared queue until it is empty.
+
+    Each of the ``transfers`` threads leases one file at a time, keeps the
+    lease alive while the file is downloaded and verified, and acknowledges
+    it. A file that failed with a transient error goes back to the queue for
+    any worker to retry; a permanent failure is recorded as failed. A worker
+    that loses the lease of a file, e.g. after being suspended for longer
+    than the lease, stops its transfer and leaves the file to the worker
+    that took it over. Files are written below the current directory, which
+    should be shared with the other workers.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        The queue to take files from.
+    timeout : int
+        Seconds without progress after which a transfer is stopped and retried. Default is 300 seconds.
+    transfers : int
+        The number of files transferred at the same time. Default is 2.
+    max_rate : int
+        The total bandwidth of this worker in kilobits per second.
+    backend : TransferBackend
+        The method used to transfer the files. Default is :class:`AsperaBackend`.
+    report : RunReport
+        Report that the metrics of every transfer are added to.
+    retry : RetryPolicy
+        How often to retry transient failures before returning a file to the
+        queue. Default is 3 attempts.
+    wait : bool
+        Keep polling for new files when the queue is empty instead of
+        exiting. Default is False.
+    poll_interval : float
+        Seconds between checks for new files or expired leases. Default is 10 seconds.
+    file_cache : FileCache
+        Shared cache that files are taken from and added to.
+
+    Returns
+    -------
+    int
+        The number of files this worker failed to download.
+    """
+    if transfers < 1:
+        raise ValueError(f"Number of transfers must be at least 1, got {transfers}")
+    scheduler = TransferScheduler(transfers, max_rate)
+    metrics.register_scheduler(scheduler)
+
+    def work() -> int:
+        failures = 0
+        while True:
+            task = queue.lease()
+            if task is None:
+                counts = queue.counts()
+                # Files leased by other workers come back if their lease expires
+                if not wait and counts[workqueue.PENDING] + counts[workqueue.LEASED] == 0:
+                    return failures
+                time.sleep(poll_interval)
+                continue
+            os.makedirs(task.run, exist_ok=True)
+            try:
+                with queue.hold(task) as lost:
+                    download_file(FastqFile(task.url, task.md5, task.bytes), task.run, timeout, scheduler, backend, report, retry=retry, file_cache=file_cache, cancel=lost)
+            except TransferCancelled:
+                # Another worker may be writing the file now, so leave it alone
+                sys.stderr.write(f"Lost the lease of {task.url}, stopped downloading it\n")
+            except Exception as e:
+                sys.stderr.write(f"Failed to download {task.url}: {e}\n")
+                queue.release(task, repr(e), retry=is_transient(e))
+                failures += 1
+            else:
+                if not queue.ack(task):
+                    sys.stderr.write(f"Lost the lease of {task.url} before it was acknowledged\n")
+
+    try:
+        with ThreadPoolExecutor(max_workers=transfers) as executor:
+            futures = [executor.submit(work) for _ in range(transfers)]
+            return sum(f.result() for f in futures)
+    finally:
+        scheduler.close()
+
+def _add_transfer_arguments(argparser: argparse.ArgumentParser) -> None:
+    argparser.add_argument('--timeout', default=300, type=int, help='Seconds without progress after which a transfer is stopped and retried. Default is 300 seconds.')
+    argparser.add_argument('--transfers', default=2, type=int, help='Maximum number of files transferred concurrently. Default is 2.')
+    argparser.add_argument('--backend', default='aspera', choices=sorted(backends), help='Method used to transfer the files. Default is aspera.')
+    argparser.add_argument('--segments', default=1, type=int, help='Number of parallel connections used for each large file with the https backend. Default is 1.')
+    argparser.add_argument('--report', type=str, help='Write per-transfer metrics and batch totals to this JSON file (NDJSON if it ends in .ndjson or .jsonl)')
+    argparser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port while downloading')
+    argparser.add_argument('--retries', default=3, type=int, help='Maximum number of attempts per file. Only transient failures such as stalls and dropped connections are retried. Default is 3.')
+    argparser.add_argument('--retry-delay', default=2.0, type=float, help='Seconds to back off before the first retry, doubled for each further retry with random jitter. Default is 2 seconds.')
+    argparser.add_argument('--max-rate', type=str, help='Total bandwidth shared by all transfers, e.g. 1g or 500m. By default aspera transfers run at 300m each and https transfers are not limited.')
+    argparser.add_argument('--file-cache', type=str, help='Shared directory of downloaded files keyed by checksum. Cached files are linked into place instead of downloaded, and new downloads are added.')
+    argparser.add_argument('--file-cache-quota', type=str, help='Maximum size of --file-cache, e.g. 2t. The least recently used files are removed beyond it. Default is no limit.')
+
+def _file_cache(argparser: argparse.ArgumentParser, args: argparse.Namespace) -> Optional[FileCache]:
+    if args.file_cache is None:
+        if args.file_cache_quota is not None:
+            argparser.error('--file-cache-quota needs --file-cache')
+        return None
+    quota = None
+    if args.file_cache_quota is not None:
+        try:
+            quota = parse_size(args.file_cache_quota)
+        except ValueError as e:
+            argparser.error(str(e))
+    file_cache = FileCache(args.file_cache, quota)
+    if quota is not None:
+        file_cache.evict()
+    return file_cache
+
+def _transfer_settings(argparser: argparse.ArgumentParser, args: argparse.Namespace) -> Tuple[TransferBackend, Optional[int], RetryPolicy]:
+    if args.transfers < 1:
+        argparser.error('--transfers must be at least 1')
+    if args.retries < 1:
+        argparser.error('--retries must be at least 1')
+    if args.retry_delay < 0:
+        argparser.error('--retry-delay must not be negative')
+    max_rate = None
+    if args.max_rate is not None:
+        try:
+            max_rate = parse_rate(args.max_rate)
+        except ValueError as e:
+            argparser.error(str(e))
+        if max_rate < args.transfers:
+            argparser.error('--max-rate is too small for the number of --transfers')
+    if args.segments < 1:
+        argparser.error('--segments must be at least 1')
+    backend: TransferBackend
+    if args.backend == 'https':
+        backend = HttpsBackend(segments=args.segments)
+    else:
+        backend = AsperaBackend(quiet=getattr(args, 'progress', False))
+    if args.metrics_port is not None:
+        metrics.start_server(args.metrics_port)
+    return backend, max_rate, RetryPolicy(args.retries, args.retry_delay)
+
 def cli():
     """
     Entry point for the command line interface. This function is called when the package is called from the command line.
     It uses the argparse package to parse the arguments passed to the command line.
 
+    ``ena-download serve-queue`` and ``ena-download worker`` run the
+    coordinator and the workers of a download spread over several hosts.
+
     Returns
     -------
     None
     """
-    argparser = argparse.ArgumentParser(description='ENA Download')
-    argparser.add_argument('accession', type=str, help='Accession number of the data to download')
-    argparser.add_argument('--timeout', default=300, type=int, help='Timeout in seconds for the download to complete. Default is 300 seconds.')
+    if sys.argv[1:2] == ['serve-queue']:
+        return cli_serve_queue(sys.argv[2:])
+    if sys.argv[1:2] == ['worker']:
+        return cli_worker(sys.argv[2:])
+
+    argparser = argparse.ArgumentParser(
+        description='ENA Download',
+        epilog='Run "ena-download serve-queue -h" and "ena-download worker -h" for downloads spread over several hosts.',
+    )
+    argparser.add_argument('accession', type=str, nargs='*', help='Accession number(s) of the data to download')
+    argparser.add_argument('--accession-file', type=str, help='File with one accession number per line')
+    argparser.add_argument('--jobs', '-j', default=1, type=int, help='Number of accessions to download concurrently. Default is 1.')
+    argparser.add_argument('--no-cache', action='store_true', help='Do not read or write the metadata cache')
+    argparser.add_argument('--refresh-cache', action='store_true', help='Query the ENA for all accessions and update the metadata cache')
+    argparser.add_argument('--adaptive', action='store_true', help='Tune the number of concurrent transfers from the observed throughput, up to --transfers')
+    argparser.add_argument('--progress', action='store_true', help='Show the combined progress of all files instead of the output of each transfer')
+    argparser.add_argument('--journal', type=str, help='Record the state of every file in this journal so an interrupted batch can be resumed')
+    argparser.add_argument('--resume', action='store_true', help='Replay the journal and only download what is still outstanding. Uses ena_download.journal.jsonl unless --journal is given')
+    argparser.add_argument('--stream-to', type=str, help='Stream the files over https into a pipeline instead of saving them: "-" for stdout, or a path template with {run} and {filename}, e.g. named pipes')
+    argparser.add_argument('--decompress', action='store_true', help='Decompress the files while streaming them with --stream-to')
+    _add_transfer_arguments(argparser)
 
     args = argparser.parse_args()
 
-    main(args.accession,args.timeout)
+    if args.decompress and not args.stream_to:
+        argparser.error('--decompress only applies with --stream-to')
+    if args.stream_to:
+        # Streaming fetches the files of one run at a time over single
+        # connections and keeps no state, so these options have no effect
+        ignored = {
+            '--jobs': args.jobs != argparser.get_default('jobs'),
+            '--transfers': args.transfers != argparser.get_default('transfers'),
+            '--segments': args.segments != argparser.get_default('segments'),
+            '--adaptive': args.adaptive,
+            '--progress': args.progress,
+            '--report': args.report is not None,
+            '--journal': args.journal is not None,
+            '--resume': args.resume,
+            '--file-cache': args.file_cache is not None,
+            '--file-cache-quota': args.file_cache_quota is not None,
+        }
+        for option, given in ignored.items():
+            if given:
+                argparser.error(f'{option} does not apply with --stream-to')
+
+    accessions = list(args.accession)
+    if args.accession_file:
+        accessions += read_accession_file(args.accession_file)
+    journal = None
+    if args.resume or args.journal:
+        journal = Journal(args.journal or 'ena_download.journal.jsonl', resume=args.resume)
+        if args.resume and not accessions:
+            accessions = list(journal.resolved)
+    if not accessions:
+        argparser.error('provide at least one accession or --accession-file')
+    if args.jobs < 1:
+        argparser.error('--jobs must be at least 1')
+    backend, max_rate, retry = _transfer_settings(argparser, args)
+
+    cache = None
+    if not args.no_cache:
+        cache = MetadataCache(refresh=args.refresh_cache)
+        cache.evict()
+
+    if args.stream_to:
+        try:
+            failed = main_stream(accessions, args.stream_to, args.decompress, cache, backend if isinstance(backend, HttpsBackend) else HttpsBackend(), args.timeout, retry, max_rate)
+        except BrokenPipeError:
+            # Keep Python from complaining about the closed pipe again at exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(1)
+        if failed:
+            sys.stderr.write(f"Failed to stream {len(failed)} of {len(set(accessions))} accessions: {', '.join(failed)}\n")
+            sys.exit(1)
+        return
+
+    report = RunReport() if args.report else None
+
+    try:
+        failed = main_many(accessions, args.timeout, args.jobs, args.transfers, max_rate, cache, backend, args.adaptive, report, args.progress, journal, retry, _file_cache(argparser, args))
+    except KeyboardInterrupt:
+        sys.stderr.write("Interrupted, stopped all transfers\n")
+        sys.exit(130)
+    finally:
+        if journal is not None:
+            journal.close()
+    if report is not None:
+        report.write(args.report)
+    if failed:
+        sys.stderr.write(f"Failed to download {len(failed)} of {len(set(accessions))} accessions: {', '.join(failed)}\n")
+        sys.exit(1)
+
+def cli_serve_queue(argv: Optional[List[str]] = None) -> None:
+    """
+    Entry point of ``ena-download serve-queue``, which fills a shared work queue and waits for the workers.
+
+    Parameters
+    ----------
+    argv : List[str]
+        The command line arguments after ``serve-queue``. Default is ``sys.argv[2:]``.
+    """
+    argparser = argparse.ArgumentParser(prog='ena-download serve-queue', description='Queue the files of a batch for ena-download worker processes on several hosts')
+    argparser.add_argument('accession', type=str, nargs='*', help='Accession number(s) of the data to download')
+    argparser.add_argument('--accession-file', type=str, help='File with one accession number per line')
+    argparser.add_argument('--queue', required=True, type=str, help='Queue database on storage shared with the workers')
+    argparser.add_argument('--max-attempts', default=3, type=int, help='Number of times a file is handed to a worker before it is marked failed. Default is 3.')
+    argparser.add_argument('--no-wait', action='store_true', help='Exit once the files are queued instead of waiting for the workers to finish')
+    argparser.add_argument('--interval', default=30.0, type=float, help='Seconds between progress reports. Default is 30 seconds.')
+    argparser.add_argument('--no-cache', action='store_true', help='Do not read or write the metadata cache')
+    argparser.add_argument('--refresh-cache', action='store_true', help='Query the ENA for all accessions and update the metadata cache')
+    args = argparser.parse_args(sys.argv[2:] if argv is None else argv)
+
+    accessions = list(args.accession)
+    if args.accession_file:
+        accessions += read_accession_file(args.accession_file)
+    if not accessions:
+        argparser.error('provide at least one accession or --accession-file')
+    if args.max_attempts < 1:
+        argparser.error('--max-attempts must be at least 1')
+
+    cache = None
+    if not args.no_cache:
+        cache = MetadataCache(refresh=args.refresh_cache)
+        cache.evict()
+    queue = WorkQueue(args.queue, max_attempts=args.max_attempts)
+    failed = serve_queue(accessions, queue, cache, wait=not args.no_wait, interval=args.interval)
+    queue.close()
+    if failed:
+        sys.stderr.write(f"Failed to download {len(failed)} accessions: {', '.join(failed)}\n")
+        sys.exit(1)
+
+def cli_worker(argv: Optional[List[str]] = None) -> None:
+    """
+    Entry point of ``ena-download worker``, which downloads files from a shared work queue.
+
+    Parameters
+    ----------
+    argv : List[str]
+        The command line arguments after ``worker``. Default is ``sys.argv[2:]``.
+    """
+    argparser = argparse.ArgumentParser(prog='ena-download worker', description='Download files queued by ena-download serve-queue into the current directory')
+    argparser.add_argument('--queue', required=True, type=str, help='Queue database on storage shared with the coordinator')
+    argparser.add_argument('--lease', default=600.0, type=float, help='Seconds after which the files of a worker that stopped responding are handed to another worker. Default is 600 seconds.')
+    argparser.add_argument('--max-attempts', default=3, type=int, help='Number of times a file is handed to a worker before it is marked failed. Default is 3.')
+    argparser.add_argument('--wait', action='store_true', help='Keep waiting for new files when the queue is empty')
+    argparser.add_argument('--poll-interval', default=10.0, type=float, help='Seconds between checks for new files. Default is 10 seconds.')
+    _add_transfer_arguments(argparser)
+    args = argparser.parse_args(sys.argv[2:] if argv is None else argv)
+
+    if args.max_attempts < 1:
+        argparser.error('--max-attempts must be at least 1')
+    if args.lease <= 0:
+        argparser.error('--lease must be positive')
+    backend, max_rate, retry = _transfer_settings(argparser, args)
+    report = RunReport() if args.report else None
+
+    queue = WorkQueue(args.queue, lease_seconds=args.lease, max_attempts=args.max_attempts)
+    failures = run_worker(queue, args.timeout, args.transfers, max_rate, backend, report, retry, args.wait, args.poll_interval, _file_cache(argparser, args))
+    queue.close()
+    if report is not None:
+        report.write(args.report)
+    if failures:
+        sys.stderr.write(f"Failed to download {failures} files\n")
+        sys.exit(1)
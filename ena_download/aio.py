@@ -0,0 +1,516 @@
+"""
+Asyncio interface for resolving and downloading data from the ENA.
+
+The coroutines mirror :func:`ena_download.resolve_accessions` and
+:func:`ena_download.download_data` without blocking the event loop: metadata
+is fetched with ``aiohttp``, ``ascp`` runs through
+``asyncio.create_subprocess_exec`` and concurrency is bounded by an
+``asyncio.Semaphore``. This module needs the optional ``aiohttp``
+dependency, which is installed with ``pip install ena_download[aio]``.
+"""
+import asyncio
+import os
+import signal
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+try:
+    import aiohttp
+except ImportError:
+    raise ImportError("ena_download.aio requires aiohttp, install it with: pip install ena_download[aio]")
+
+from . import (
+    AsperaBackend, ChecksumError, FastqFile, FilereportRecord, HttpsBackend,
+    RetryPolicy, TransferBackend, accession_pattern, compute_md5,
+    filereport_fields, http_timeout, is_complete, is_transient, iter_records,
+    records_to_files, retry_statuses, run_accession_pattern, unknown_accession_statuses,
+)
+from .cache import MetadataCache
+
+def client_session() -> aiohttp.ClientSession:
+    """
+    Create an HTTP session with the same timeouts as the blocking API.
+
+    Returns
+    -------
+    aiohttp.ClientSession
+        A new session. The caller is responsible for closing it.
+    """
+    timeout = aiohttp.ClientTimeout(sock_connect=http_timeout[0], sock_read=http_timeout[1])
+    return aiohttp.ClientSession(timeout=timeout)
+
+async def fetch_text(session: aiohttp.ClientSession, url: str, data: Optional[Dict[str, str]] = None, retries: int = 5) -> Optional[str]:
+    """
+    Fetch a portal API response, retrying connection errors and the statuses in :data:`ena_download.retry_statuses` with backoff.
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+        The session to use.
+    url : str
+        The URL to fetch.
+    data : Dict[str, str]
+        Form data. If given the request is sent with POST, otherwise with GET.
+    retries : int
+        The maximum number of retries. Default is 5.
+
+    Returns
+    -------
+    str
+        The body of the response, or None if the portal answered with one of
+        the statuses in :data:`ena_download.unknown_accession_statuses`.
+
+    Raises
+    ------
+    aiohttp.ClientResponseError
+        If the response has any other error status, or a retried one after the last retry.
+    """
+    return await _fetch(session, url, data, retries, lambda response: response.text())
+
+async def _fetch(session: aiohttp.ClientSession, url: str, data: Optional[Dict[str, str]], retries: int, read: Callable[[aiohttp.ClientResponse], Awaitable[Any]]) -> Any:
+    attempt = 0
+    while True:
+        try:
+            if data is None:
+                request = session.get(url)
+            else:
+                request = session.post(url, data=data)
+            async with request as response:
+                if response.status == 200:
+                    # A connection dropped while reading is retried from the start
+                    return await read(response)
+                error = aiohttp.ClientResponseError(
+                    response.request_info, response.history, status=response.status,
+                    message=response.reason or "", headers=response.headers,
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+        else:
+            if error.status in unknown_accession_statuses:
+                return None
+            if error.status not in retry_statuses or attempt == retries:
+                raise error
+        await asyncio.sleep(0.5 * 2 ** attempt)
+        attempt += 1
+
+async def read_records(response: aiohttp.ClientResponse, block_size: int = 1000) -> List[FilereportRecord]:
+    """
+    Parse a filereport response into records while it streams in.
+
+    The body is read line by line and parsed in blocks of ``block_size``
+    lines with :func:`ena_download.iter_records`, so the text of a large
+    response is never held in memory as a whole.
+
+    Parameters
+    ----------
+    response : aiohttp.ClientResponse
+        The response, with the header line first.
+    block_size : int
+        The number of lines parsed at a time. Default is 1000.
+
+    Returns
+    -------
+    List[FilereportRecord]
+        One record per run.
+    """
+    records: List[FilereportRecord] = []
+    header: Optional[str] = None
+    block: List[str] = []
+    async for raw in response.content:
+        line = raw.decode()
+        if header is None:
+            if line.strip() != "":
+                header = line
+            continue
+        block.append(line)
+        if len(block) == block_size:
+            records.extend(iter_records([header] + block))
+            block = []
+    if header is not None:
+        records.extend(iter_records([header] + block))
+    return records
+
+async def fetch_records(session: aiohttp.ClientSession, url: str, data: Optional[Dict[str, str]] = None, retries: int = 5) -> Optional[List[FilereportRecord]]:
+    """
+    Fetch a portal API TSV response as records, retrying like :func:`fetch_text`.
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+        The session to use.
+    url : str
+        The URL to fetch.
+    data : Dict[str, str]
+        Form data. If given the request is sent with POST, otherwise with GET.
+    retries : int
+        The maximum number of retries. Default is 5.
+
+    Returns
+    -------
+    List[FilereportRecord]
+        The records of the response, or None if the portal answered with one
+        of the statuses in :data:`ena_download.unknown_accession_statuses`.
+
+    Raises
+    ------
+    aiohttp.ClientResponseError
+        If the response has any other error status, or a retried one after the last retry.
+    """
+    return await _fetch(session, url, data, retries, read_records)
+
+async def resolve(accessions: Iterable[str], chunk_size: int = 500, cache: Optional[MetadataCache] = None, session: Optional[aiohttp.ClientSession] = None, concurrency: int = 8) -> Dict[str, List[FastqFile]]:
+    """
+    Get the files to download for many accessions at once.
+
+    This is the asynchronous version of :func:`ena_download.resolve_accessions`.
+    Malformed accessions are ignored.
+
+    Parameters
+    ----------
+    accessions : Iterable[str]
+        The accession numbers to resolve.
+    chunk_size : int
+        The maximum number of run accessions sent in one query. Default is 500.
+    cache : MetadataCache
+        Cache that is checked before, and filled after, querying the ENA.
+    session : aiohttp.ClientSession
+        Session used for the queries. A new one is created if not given.
+    concurrency : int
+        The maximum number of queries in flight. Default is 8.
+
+    Returns
+    -------
+    Dict[str, List[FastqFile]]
+        The files of the data to download, keyed by run accession.
+    """
+    files, _ = await _resolve(accessions, chunk_size, cache, session, concurrency)
+    return files
+
+async def _resolve(accessions: Iterable[str], chunk_size: int = 500, cache: Optional[MetadataCache] = None, session: Optional[aiohttp.ClientSession] = None, concurrency: int = 8) -> Tuple[Dict[str, List[FastqFile]], Dict[str, List[str]]]:
+    # Also returns the runs each accession other than a run accession expanded into
+    if session is None:
+        async with client_session() as session:
+            return await _resolve(accessions, chunk_size, cache, session, concurrency)
+
+    unique_accessions = [a for a in dict.fromkeys(accessions) if accession_pattern.match(a)]
+    runs = [a for a in unique_accessions if run_accession_pattern.match(a)]
+    others = [a for a in unique_accessions if not run_accession_pattern.match(a)]
+
+    records: List[FilereportRecord] = []
+    expansions: Dict[str, List[str]] = {}
+    if cache is not None:
+        cached = cache.get_rows(runs)
+        records.extend(FilereportRecord.from_row(row) for row in cached.values())
+        runs = [r for r in runs if r not in cached]
+        for accession in list(others):
+            expansion = cache.get_expansion(accession)
+            if expansion:
+                cached = cache.get_rows(expansion)
+                if len(cached) == len(expansion):
+                    records.extend(FilereportRecord.from_row(row) for row in cached.values())
+                    expansions[accession] = expansion
+                    others.remove(accession)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def query_runs(chunk: List[str]) -> None:
+        async with semaphore:
+            new_records = await fetch_records(session, "https://www.ebi.ac.uk/ena/portal/api/search", {
+                "result": "read_run",
+                "includeAccessions": ",".join(chunk),
+                "fields": filereport_fields,
+                "format": "tsv",
+                "limit": "0",
+            })
+        if new_records is None:
+            raise ValueError("Invalid URL: https://www.ebi.ac.uk/ena/portal/api/search")
+        if cache is not None:
+            cache.put_rows(r.to_row() for r in new_records)
+        records.extend(new_records)
+
+    async def query_accession(accession: str) -> None:
+        url = f"https://www.ebi.ac.uk/ena/portal/api/filereport?accession={accession}&result=read_run&fields={filereport_fields}"
+        async with semaphore:
+            new_records = await fetch_records(session, url)
+        # Unknown accessions are left out of the result rather than failing the batch
+        expansions[accession] = [r.run_accession for r in new_records or []]
+        if not new_records:
+            return
+        if cache is not None:
+            cache.put_rows(r.to_row() for r in new_records)
+            cache.put_expansion(accession, [r.run_accession for r in new_records])
+        records.extend(new_records)
+
+    await asyncio.gather(
+        *[query_runs(runs[i:i + chunk_size]) for i in range(0, len(runs), chunk_size)],
+        *[query_accession(accession) for accession in others],
+    )
+    return records_to_files(records), expansions
+
+async def kill_process_group(proc: asyncio.subprocess.Process, grace: float = 5.0) -> None:
+    """
+    Terminate a process started with ``start_new_session=True`` and all its children.
+
+    Parameters
+    ----------
+    proc : asyncio.subprocess.Process
+        The process to kill.
+    grace : float
+        Seconds to wait after SIGTERM before sending SIGKILL. Default is 5 seconds.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), grace)
+        except asyncio.TimeoutError:
+            os.killpg(proc.pid, signal.SIGKILL)
+            await proc.wait()
+    except ProcessLookupError:
+        pass
+
+async def run_with_watchdog(cmd: List[str], watch_files: List[str], timeout: int = 300, poll_interval: float = 1.0) -> None:
+    """
+    Run a transfer command and kill it if it stops making progress.
+
+    This is the asynchronous version of :func:`ena_download.run_with_watchdog`.
+    The process group is also killed if the coroutine is cancelled.
+
+    Parameters
+    ----------
+    cmd : List[str]
+        The command to run.
+    watch_files : List[str]
+        Files whose combined size is used to detect progress.
+    timeout : int
+        Seconds without any growth of ``watch_files`` after which the command
+        is killed. Default is 300 seconds.
+    poll_interval : float
+        Seconds between checks. Default is 1 second.
+    """
+    def watched_size() -> int:
+        total = 0
+        for f in watch_files:
+            try:
+                total += os.path.getsize(f)
+            except OSError:
+                pass
+        return total
+
+    proc = await asyncio.create_subprocess_exec(*cmd, start_new_session=True)
+    try:
+        last_size = watched_size()
+        last_progress = time.monotonic()
+        while True:
+            try:
+                returncode = await asyncio.wait_for(proc.wait(), poll_interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+            size = watched_size()
+            now = time.monotonic()
+            if size != last_size:
+                last_size = size
+                last_progress = now
+            elif now - last_progress > timeout:
+                raise TimeoutError(f"Transfer stalled for {timeout} seconds: {' '.join(cmd)}")
+    finally:
+        if proc.returncode is None:
+            await kill_process_group(proc)
+    if returncode != 0:
+        raise OSError(f"Command exited with status {returncode}: {' '.join(cmd)}")
+
+async def https_transfer(session: aiohttp.ClientSession, backend: HttpsBackend, fastq_file: FastqFile, filename: str, timeout: int = 300) -> None:
+    """
+    Download a file over HTTPS, resuming a partial file with a Range request.
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+        The session to use.
+    backend : HttpsBackend
+        Backend that provides the mirror URL and chunk size.
+    fastq_file : FastqFile
+        The file as listed by the ENA.
+    filename : str
+        The local path to write the file to.
+    timeout : int
+        Seconds without receiving data after which the transfer is stopped.
+    """
+    offset = os.path.getsize(filename) if os.path.exists(filename) else 0
+    if fastq_file.bytes is not None and offset == fastq_file.bytes:
+        return
+    headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+    request_timeout = aiohttp.ClientTimeout(sock_connect=http_timeout[0], sock_read=timeout)
+    async with session.get(backend.file_url(fastq_file), headers=headers, timeout=request_timeout) as response:
+        if response.status == 416:
+            # The partial file is already as large as the remote file
+            return
+        response.raise_for_status()
+        mode = "ab" if response.status == 206 else "wb"
+        with open(filename, mode) as f:
+            async for chunk in response.content.iter_chunked(backend.chunk_size):
+                f.write(chunk)
+
+async def download_file(fastq_file: FastqFile, accession: str, semaphore: asyncio.Semaphore, timeout: int = 300, backend: Optional[TransferBackend] = None, session: Optional[aiohttp.ClientSession] = None, retries: int = 3) -> None:
+    """
+    Download a single file, verify its checksum and retry on failure.
+
+    Parameters
+    ----------
+    fastq_file : FastqFile
+        The file as listed by the ENA.
+    accession : str
+        The accession number of the data, used as the output directory.
+    semaphore : asyncio.Semaphore
+        Semaphore that bounds the number of concurrent transfers.
+    timeout : int
+        Seconds without progress after which a transfer is stopped and retried. Default is 300 seconds.
+    backend : TransferBackend
+        :class:`ena_download.AsperaBackend` (default) or :class:`ena_download.HttpsBackend`.
+    session : aiohttp.ClientSession
+        Session used by the HTTPS backend.
+    retries : int
+        The number of attempts before giving up. Only transient failures are
+        retried, after an exponential backoff with jitter. Default is 3.
+    """
+    if backend is None:
+        backend = AsperaBackend()
+    loop = asyncio.get_event_loop()
+    filename = os.path.join(accession, fastq_file.filename)
+    # Checking an existing file may hash it, which is done off the event loop
+    if await loop.run_in_executor(None, is_complete, filename, fastq_file):
+        sys.stderr.write(f"Skipping {fastq_file.url}, already downloaded\n")
+        return
+
+    policy = RetryPolicy(retries)
+    for i in range(retries):
+        sys.stderr.write(f"Attempt {i+1} at downloading {fastq_file.url}...\n")
+        try:
+            async with semaphore:
+                if isinstance(backend, AsperaBackend):
+                    backend.check()
+                    await run_with_watchdog(backend.command(fastq_file, filename), [filename, filename + '.partial'], timeout)
+                elif isinstance(backend, HttpsBackend):
+                    if session is None:
+                        raise ValueError("The https backend needs an aiohttp session")
+                    await https_transfer(session, backend, fastq_file, filename, timeout)
+                else:
+                    raise ValueError(f"Backend {backend.name} is not supported by ena_download.aio")
+            if fastq_file.md5 != "" and await loop.run_in_executor(None, compute_md5, filename) != fastq_file.md5:
+                sys.stderr.write(f"Checksum mismatch for {filename}, downloading again\n")
+                os.remove(filename)
+                raise ChecksumError(f"Checksum mismatch for {filename}")
+            return
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            if i + 1 < retries:
+                await asyncio.sleep(policy.delay(i))
+    raise TimeoutError(f"Download failed after {retries} attempts")
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Check whether a failed transfer attempt is worth retrying.
+
+    Like :func:`ena_download.is_transient`, but also treating ``aiohttp``
+    connection errors and asyncio timeouts as transient.
+    """
+    if isinstance(error, asyncio.TimeoutError) or \
+            (isinstance(error, aiohttp.ClientError) and not isinstance(error, aiohttp.ClientResponseError)):
+        return True
+    return is_transient(error)
+
+async def download(accession: str, files: Sequence[Union[str, FastqFile]], timeout: int = 300, semaphore: Optional[asyncio.Semaphore] = None, backend: Optional[TransferBackend] = None, session: Optional[aiohttp.ClientSession] = None) -> None:
+    """
+    Download the files of a run concurrently.
+
+    This is the asynchronous version of :func:`ena_download.download_data`.
+
+    Parameters
+    ----------
+    accession : str
+        The accession number of the data, used as the output directory.
+    files : list of str or FastqFile
+        The URLs of the data to download, or the files as returned by :func:`resolve`.
+    timeout : int
+        Seconds without progress after which a transfer is stopped and retried. Default is 300 seconds.
+    semaphore : asyncio.Semaphore
+        Semaphore shared between downloads to cap the number of concurrent
+        transfers. A new semaphore allowing 2 transfers is used if not given.
+    backend : TransferBackend
+        :class:`ena_download.AsperaBackend` (default) or :class:`ena_download.HttpsBackend`.
+    session : aiohttp.ClientSession
+        Session used by the HTTPS backend. A new one is created if needed and not given.
+    """
+    if session is None and isinstance(backend, HttpsBackend):
+        async with client_session() as session:
+            return await download(accession, files, timeout, semaphore, backend, session)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(2)
+
+    os.makedirs(accession, exist_ok=True)
+    fastq_files = [f if isinstance(f, FastqFile) else FastqFile(f) for f in files]
+    results = await asyncio.gather(
+        *[download_file(f, accession, semaphore, timeout, backend, session) for f in fastq_files],
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+async def download_many(accessions: Iterable[str], timeout: int = 300, transfers: int = 2, backend: Optional[TransferBackend] = None, cache: Optional[MetadataCache] = None) -> List[str]:
+    """
+    Resolve and download many accessions.
+
+    This is the asynchronous version of :func:`ena_download.main_many`.
+
+    Parameters
+    ----------
+    accessions : Iterable[str]
+        The accession numbers of the data to download.
+    timeout : int
+        Seconds without progress after which a transfer is stopped and retried. Default is 300 seconds.
+    transfers : int
+        The maximum number of files transferred at the same time. Default is 2.
+    backend : TransferBackend
+        :class:`ena_download.AsperaBackend` (default) or :class:`ena_download.HttpsBackend`.
+    cache : MetadataCache
+        Cache for the metadata of the accessions.
+
+    Returns
+    -------
+    List[str]
+        The accession numbers that could not be resolved and the runs that
+        could not be downloaded.
+    """
+    unique_accessions = list(dict.fromkeys(accessions))
+    semaphore = asyncio.Semaphore(transfers)
+    async with client_session() as session:
+        files, expansions = await _resolve(unique_accessions, cache=cache, session=session)
+
+        # The same rule as ena_download.resolve_batch: malformed accessions, well
+        # formed ones the portal returned no run for, and runs without fastq
+        # files are failures
+        failed = [
+            a for a in unique_accessions
+            if not accession_pattern.match(a)
+            or (a not in files if run_accession_pattern.match(a) else not expansions.get(a))
+        ]
+        for accession in failed:
+            sys.stderr.write(f"Failed to download {accession}: Invalid accession number: {accession}\n")
+        for run in [r for r, run_files in files.items() if not run_files]:
+            sys.stderr.write(f"Failed to download {run}: No fastq files for {run}\n")
+            failed.append(run)
+
+        runs = [r for r, run_files in files.items() if run_files]
+        results = await asyncio.gather(
+            *[download(run, files[run], timeout, semaphore, backend, session) for run in runs],
+            return_exceptions=True,
+        )
+    for run, result in zip(runs, results):
+        if isinstance(result, BaseException):
+            sys.stderr.write(f"Failed to download {run}: {result}\n")
+            failed.append(run)
+    return failed
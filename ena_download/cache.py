@@ -0,0 +1,187 @@
+"""
+Persistent on-disk cache for metadata returned by the ENA portal API.
+"""
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+def default_cache_dir() -> str:
+    """
+    Get the directory used for cached data.
+
+    Returns
+    -------
+    str
+        ``$XDG_CACHE_HOME/ena_download``, falling back to ``~/.cache/ena_download``.
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "ena_download")
+
+class MetadataCache:
+    """
+    SQLite cache of filereport rows keyed by run accession.
+
+    The cache stores the ``run_accession``, ``fastq_ftp``, ``fastq_md5`` and
+    ``fastq_bytes`` of every run that has been resolved, together with the
+    list of runs that a study, sample, experiment or project expands into.
+    Entries older than ``ttl`` seconds are ignored and removed on
+    :meth:`evict`, which also drops the oldest entries once the cache holds
+    more than ``max_entries`` runs.
+
+    The cache can be shared between threads.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite database. Default is ``metadata.sqlite`` in :func:`default_cache_dir`.
+    ttl : int
+        Time in seconds after which an entry is stale. Default is 7 days.
+    max_entries : int
+        Maximum number of runs kept in the cache. Default is 1,000,000.
+    refresh : bool
+        If True, lookups always miss so every accession is fetched again and
+        the cached entries are overwritten. Default is False.
+
+    Examples
+    --------
+    >>> cache = MetadataCache(":memory:")
+    >>> cache.put_rows([{"run_accession": "ERR1", "fastq_ftp": "a;b", "fastq_md5": "x;y", "fastq_bytes": "1;2"}])
+    >>> cache.get_rows(["ERR1", "ERR2"])
+    {'ERR1': {'run_accession': 'ERR1', 'fastq_ftp': 'a;b', 'fastq_md5': 'x;y', 'fastq_bytes': '1;2'}}
+    """
+    columns = ("run_accession", "fastq_ftp", "fastq_md5", "fastq_bytes")
+
+    def __init__(self, path: Optional[str] = None, ttl: int = 7 * 24 * 3600, max_entries: int = 1000000, refresh: bool = False) -> None:
+        if path is None:
+            os.makedirs(default_cache_dir(), exist_ok=True)
+            path = os.path.join(default_cache_dir(), "metadata.sqlite")
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "run_accession TEXT PRIMARY KEY, fastq_ftp TEXT, fastq_md5 TEXT, "
+                "fastq_bytes TEXT, fetched REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS runs_fetched ON runs (fetched)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS expansions ("
+                "accession TEXT PRIMARY KEY, runs TEXT NOT NULL, fetched REAL NOT NULL)"
+            )
+
+    def _fresh_after(self) -> float:
+        return time.time() - self.ttl
+
+    def get_rows(self, accessions: Iterable[str]) -> Dict[str, Dict[str, str]]:
+        """
+        Look up cached rows for run accessions.
+
+        Parameters
+        ----------
+        accessions : Iterable[str]
+            The run accession numbers to look up.
+
+        Returns
+        -------
+        Dict[str, Dict[str, str]]
+            The cached rows of the runs that have a fresh entry, keyed by run accession.
+        """
+        if self.refresh:
+            return {}
+        rows = {}
+        accessions = list(accessions)
+        with self._lock:
+            # Stay well below SQLite's limit on the number of query parameters
+            for i in range(0, len(accessions), 500):
+                chunk = accessions[i:i + 500]
+                params: List[object] = [self._fresh_after()]
+                cursor = self._conn.execute(
+                    f"SELECT {', '.join(self.columns)} FROM runs "
+                    f"WHERE fetched >= ? AND run_accession IN ({', '.join('?' * len(chunk))})",
+                    params + chunk,
+                )
+                for values in cursor:
+                    rows[values[0]] = dict(zip(self.columns, (v or "" for v in values)))
+        return rows
+
+    def put_rows(self, rows: Iterable[Dict[str, str]]) -> None:
+        """
+        Store filereport rows in the cache.
+
+        Parameters
+        ----------
+        rows : Iterable[Dict[str, str]]
+            Rows as returned by :meth:`ena_download.FilereportRecord.to_row`.
+        """
+        now = time.time()
+        values = [tuple(row.get(c, "") for c in self.columns) + (now,) for row in rows]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)", values
+            )
+
+    def get_expansion(self, accession: str) -> Optional[List[str]]:
+        """
+        Look up the runs that an accession expands into.
+
+        Parameters
+        ----------
+        accession : str
+            A study, sample, experiment or project accession number.
+
+        Returns
+        -------
+        List[str]
+            The run accessions, or None if there is no fresh entry.
+        """
+        if self.refresh:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT runs FROM expansions WHERE accession = ? AND fetched >= ?",
+                (accession, self._fresh_after()),
+            ).fetchone()
+        if row is None:
+            return None
+        return [r for r in row[0].split(",") if r != ""]
+
+    def put_expansion(self, accession: str, runs: Iterable[str]) -> None:
+        """
+        Store the runs that an accession expands into.
+
+        Parameters
+        ----------
+        accession : str
+            A study, sample, experiment or project accession number.
+        runs : Iterable[str]
+            The run accessions.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO expansions VALUES (?, ?, ?)",
+                (accession, ",".join(runs), time.time()),
+            )
+
+    def evict(self) -> None:
+        """Remove stale entries and trim the cache to ``max_entries`` runs, oldest first."""
+        with self._lock:
+            fresh_after = self._fresh_after()
+            self._conn.execute("DELETE FROM runs WHERE fetched < ?", (fresh_after,))
+            self._conn.execute("DELETE FROM expansions WHERE fetched < ?", (fresh_after,))
+            self._conn.execute(
+                "DELETE FROM runs WHERE run_accession IN ("
+                "SELECT run_accession FROM runs ORDER BY fetched DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def close(self) -> None:
+        """Close the underlying database connection."""
+        with self._lock:
+            self._conn.close()
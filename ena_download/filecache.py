@@ -0,0 +1,248 @@
+"""
+Content-addressed cache of downloaded files that can be shared between projects.
+"""
+import errno
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from typing import List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # type: ignore
+
+FICLONE = 0x40049409
+"""Linux ioctl that makes a copy-on-write clone of a file on btrfs, XFS and similar filesystems."""
+
+md5_pattern = re.compile(r"^[0-9a-f]{32}$")
+
+def reflink(src: str, dst: str) -> None:
+    """
+    Clone a file without copying its data.
+
+    Parameters
+    ----------
+    src : str
+        The file to clone.
+    dst : str
+        The new file.
+
+    Raises
+    ------
+    OSError
+        If the platform or filesystem does not support reflinks.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+class FileCache:
+    """
+    Directory of files keyed by their MD5 checksum.
+
+    Files are stored as ``objects/<md5[:2]>/<md5>`` and made read-only.
+    A hit is placed in the target directory as a reflink if the filesystem
+    supports it, otherwise as a hard link, and only copied if the target is
+    on another filesystem. As hard links share the stored file, files
+    placed from the cache are read-only too.
+
+    Every hit updates the modification time of the stored file. When the
+    files in the cache exceed ``quota`` bytes, the least recently used ones
+    are removed. A removed file still takes up space while a hard link to
+    it exists elsewhere.
+
+    Several processes, on one host or several hosts sharing the directory,
+    can use the cache at the same time.
+
+    Parameters
+    ----------
+    path : str
+        The cache directory, created if it does not exist.
+    quota : int
+        The maximum total size in bytes, or None for no limit.
+
+    Examples
+    --------
+    >>> directory = tempfile.mkdtemp()
+    >>> cache = FileCache(os.path.join(directory, "cache"))
+    >>> with open(os.path.join(directory, "a.fastq.gz"), "w") as f:
+    ...     _ = f.write("@r1")
+    >>> cache.put("0123456789abcdef0123456789abcdef", os.path.join(directory, "a.fastq.gz"))
+    True
+    >>> cache.get("0123456789abcdef0123456789abcdef", os.path.join(directory, "b.fastq.gz"))
+    True
+    >>> open(os.path.join(directory, "b.fastq.gz")).read()
+    '@r1'
+    """
+    def __init__(self, path: str, quota: Optional[int] = None) -> None:
+        self.path = path
+        self.quota = quota
+        self.objects = os.path.join(path, "objects")
+        os.makedirs(self.objects, exist_ok=True)
+        self._lock = threading.Lock()
+        # Estimate of the cache size, recounted from disk when it passes the quota
+        self._size: Optional[int] = None
+
+    def object_path(self, md5: str) -> str:
+        """Get the path a file with this checksum is stored at."""
+        if not md5_pattern.match(md5):
+            raise ValueError(f"Invalid MD5 checksum: {md5}")
+        return os.path.join(self.objects, md5[:2], md5)
+
+    def _place(self, src: str, dst: str, prefer_link: bool) -> None:
+        # Write next to the destination and rename, so that nobody sees a
+        # partial file under the final name
+        directory = os.path.dirname(dst) or "."
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        os.close(fd)
+        os.remove(tmp)
+        try:
+            methods = (os.link, reflink) if prefer_link else (reflink, os.link)
+            for method in methods:
+                try:
+                    method(src, tmp)
+                    break
+                except OSError:
+                    continue
+            else:
+                shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _touch(self, stored: str) -> None:
+        try:
+            os.utime(stored)
+        except PermissionError:
+            # Only the owner may set the time of a read-only file, so files
+            # added by other users age from when they were added
+            pass
+
+    def get(self, md5: str, filename: str) -> bool:
+        """
+        Place a cached file at ``filename``.
+
+        Parameters
+        ----------
+        md5 : str
+            The checksum of the file.
+        filename : str
+            Where to put the file.
+
+        Returns
+        -------
+        bool
+            True if the file was in the cache.
+        """
+        stored = self.object_path(md5)
+        if not os.path.exists(stored):
+            return False
+        try:
+            self._place(stored, filename, prefer_link=False)
+        except FileNotFoundError:
+            # Evicted by another process in the meantime
+            return False
+        self._touch(stored)
+        return True
+
+    def put(self, md5: str, filename: str) -> bool:
+        """
+        Add a downloaded file to the cache. The checksum is not verified again.
+
+        Parameters
+        ----------
+        md5 : str
+            The checksum of the file.
+        filename : str
+            The file to add.
+
+        Returns
+        -------
+        bool
+            True if the file was added, False if it was already cached.
+        """
+        stored = self.object_path(md5)
+        if os.path.exists(stored):
+            self._touch(stored)
+            return False
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        # A hard link adds the file without copying it, but only protects the
+        # cache from later changes to the file if it is read-only
+        os.chmod(filename, 0o444)
+        self._place(filename, stored, prefer_link=True)
+        os.chmod(stored, 0o444)
+        size = os.path.getsize(stored)
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            over_quota = self.quota is not None and (self._size is None or self._size > self.quota)
+        if over_quota:
+            self.evict()
+        return True
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        """
+        List the stored files.
+
+        Returns
+        -------
+        List[Tuple[float, int, str]]
+            The last use time, size and path of every file, least recently used first.
+        """
+        entries = []
+        for prefix in os.listdir(self.objects):
+            directory = os.path.join(self.objects, prefix)
+            try:
+                names = os.listdir(directory)
+            except NotADirectoryError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.startswith(".tmp-"):
+                    # Left behind by a process that died while adding a file
+                    if st.st_mtime < time.time() - 24 * 3600:
+                        os.remove(path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used files until the cache is within its quota.
+
+        Returns
+        -------
+        int
+            The number of bytes removed.
+        """
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+        removed = 0
+        if self.quota is not None:
+            for mtime, n, path in entries:
+                if size - removed <= self.quota:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                removed += n
+        with self._lock:
+            self._size = size - removed
+        return removed
@@ -0,0 +1,139 @@
+"""
+Durable journal of download progress, used to resume interrupted batches.
+"""
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+RESOLVED = "resolved"
+TRANSFERRING = "transferring"
+DOWNLOADED = "downloaded"
+VERIFIED = "verified"
+FAILED = "failed"
+
+class Journal:
+    """
+    Append-only JSON lines log of the state of every file in a batch.
+
+    Each line records either the runs an accession resolved to, or a new
+    state of one file: ``resolved``, ``transferring``, ``downloaded``,
+    ``verified`` or ``failed``. Every line is flushed and synced to disk
+    before the call returns, so the journal survives the process being
+    killed. A line cut short by a crash is ignored on replay, and removed
+    before the journal is appended to.
+
+    The journal can be shared between threads.
+
+    Parameters
+    ----------
+    path : str
+        The journal file.
+    resume : bool
+        If True, the existing journal is replayed and appended to. Otherwise
+        it is truncated. Default is False.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "journal.jsonl")
+    >>> journal = Journal(path)
+    >>> journal.record_resolved("PRJEB1", {"ERR1": [{"url": "a", "md5": "x", "bytes": 1}]})
+    >>> journal.set_state("ERR1", "a", VERIFIED)
+    >>> journal.close()
+    >>> journal = Journal(path, resume=True)
+    >>> journal.resolved["PRJEB1"], journal.state("ERR1", "a")
+    (['ERR1'], 'verified')
+    """
+    def __init__(self, path: str, resume: bool = False) -> None:
+        self.path = path
+        # Runs of each resolved accession, files of each run and file states
+        self.resolved: Dict[str, List[str]] = {}
+        self.files: Dict[str, List[Dict[str, Any]]] = {}
+        self.states: Dict[Tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+        # Bytes of the journal file up to the end of its last complete line
+        self._complete_size = 0
+        if resume and os.path.exists(path):
+            self.replay()
+            if self._complete_size != os.path.getsize(path):
+                # Otherwise the next event would be appended to the partial last line
+                os.truncate(path, self._complete_size)
+        self._file = open(path, "a" if resume else "w")
+
+    def replay(self) -> None:
+        """Load the state recorded in the journal file."""
+        size = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A partial line written as the process died
+                    break
+                size += len(line)
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                self._apply(event)
+        self._complete_size = size
+
+    def _apply(self, event: Dict[str, Any]) -> None:
+        if "accession" in event:
+            self.resolved[event["accession"]] = event["runs"]
+        elif "file" in event:
+            run = event["run"]
+            run_files = self.files.setdefault(run, [])
+            if all(f["url"] != event["file"]["url"] for f in run_files):
+                run_files.append(event["file"])
+            self.states[(run, event["file"]["url"])] = RESOLVED
+        else:
+            self.states[(event["run"], event["url"])] = event["state"]
+
+    def _write(self, event: Dict[str, Any]) -> None:
+        with self._lock:
+            self._apply(event)
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def record_resolved(self, accession: str, files: Dict[str, List[Dict[str, Any]]]) -> None:
+        """
+        Record the runs and files that an accession resolved to.
+
+        Parameters
+        ----------
+        accession : str
+            The accession that was resolved.
+        files : Dict[str, List[Dict[str, Any]]]
+            The files of each run, as dictionaries with ``url``, ``md5`` and ``bytes``.
+        """
+        for run, run_files in files.items():
+            for f in run_files:
+                if (run, f["url"]) not in self.states:
+                    self._write({"run": run, "file": f})
+        self._write({"accession": accession, "runs": list(files)})
+
+    def set_state(self, run: str, url: str, state: str) -> None:
+        """
+        Record a new state of a file.
+
+        Parameters
+        ----------
+        run : str
+            The run the file belongs to.
+        url : str
+            The URL of the file.
+        state : str
+            One of ``transferring``, ``downloaded``, ``verified`` or ``failed``.
+        """
+        self._write({"run": run, "url": url, "state": state})
+
+    def state(self, run: str, url: str) -> Optional[str]:
+        """Get the last recorded state of a file, or None if it is not in the journal."""
+        with self._lock:
+            return self.states.get((run, url))
+
+    def close(self) -> None:
+        """Close the journal file."""
+        with self._lock:
+            self._file.close()
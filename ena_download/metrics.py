@@ -0,0 +1,126 @@
+"""
+Optional Prometheus metrics for long-running downloads.
+
+Nothing is recorded until :func:`start_server` is called, so the functions
+in this module are cheap no-ops by default. Serving metrics needs the
+optional ``prometheus_client`` dependency, which is installed with
+``pip install ena_download[metrics]``.
+"""
+import threading
+from typing import Any, Iterator, List, Optional
+
+_metrics: Optional["Metrics"] = None
+_lock = threading.Lock()
+
+class Metrics:
+    """
+    The Prometheus instruments of one process, kept in their own registry.
+
+    Parameters
+    ----------
+    registry : prometheus_client.CollectorRegistry
+        The registry the instruments are added to.
+    """
+    def __init__(self, registry: Any) -> None:
+        from prometheus_client import Counter, Histogram
+
+        self.registry = registry
+        self.schedulers: List[Any] = []
+        self.retries = Counter(
+            "ena_download_retries", "Transfer attempts that failed and were retried",
+            registry=registry,
+        )
+        self.files = Counter(
+            "ena_download_files", "Files finished, by status",
+            ["status"], registry=registry,
+        )
+        self.metadata_seconds = Histogram(
+            "ena_download_metadata_query_seconds", "Latency of ENA portal API queries",
+            registry=registry,
+        )
+        self.checksum_seconds = Histogram(
+            "ena_download_checksum_seconds", "Time spent verifying MD5 checksums",
+            buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, float("inf")),
+            registry=registry,
+        )
+        registry.register(SchedulerCollector(self))
+
+class SchedulerCollector:
+    """
+    Reports the live state of the registered transfer schedulers at scrape time.
+
+    Parameters
+    ----------
+    metrics : Metrics
+        The metrics whose schedulers are reported.
+    """
+    def __init__(self, metrics: Metrics) -> None:
+        self.metrics = metrics
+
+    def collect(self) -> Iterator[Any]:
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+        schedulers = list(self.metrics.schedulers)
+        transferred = CounterMetricFamily("ena_download_bytes", "Bytes written to disk by transfers")
+        transferred.add_metric([], sum(s.bytes_transferred() for s in schedulers))
+        yield transferred
+        active = GaugeMetricFamily("ena_download_active_transfers", "Transfers currently running")
+        active.add_metric([], sum(s.active for s in schedulers))
+        yield active
+        queued = GaugeMetricFamily("ena_download_queue_depth", "Transfers waiting for a slot")
+        queued.add_metric([], sum(s.waiting for s in schedulers))
+        yield queued
+        limit = GaugeMetricFamily("ena_download_transfer_limit", "Current limit on concurrent transfers")
+        limit.add_metric([], sum(s.limit for s in schedulers))
+        yield limit
+
+def start_server(port: int, addr: str = "0.0.0.0") -> None:
+    """
+    Start recording metrics and serve them over HTTP for Prometheus to scrape.
+
+    Parameters
+    ----------
+    port : int
+        The port to listen on.
+    addr : str
+        The address to listen on. Default is all interfaces.
+
+    Raises
+    ------
+    ImportError
+        If ``prometheus_client`` is not installed.
+    """
+    global _metrics
+    try:
+        from prometheus_client import CollectorRegistry, start_http_server
+    except ImportError:
+        raise ImportError("Serving metrics requires prometheus_client, install it with: pip install ena_download[metrics]")
+    with _lock:
+        if _metrics is None:
+            _metrics = Metrics(CollectorRegistry())
+        start_http_server(port, addr=addr, registry=_metrics.registry)
+
+def register_scheduler(scheduler: Any) -> None:
+    """Report the state of a :class:`ena_download.TransferScheduler`."""
+    if _metrics is not None:
+        _metrics.schedulers.append(scheduler)
+
+def observe_metadata_query(seconds: float) -> None:
+    """Record the latency of a portal API query."""
+    if _metrics is not None:
+        _metrics.metadata_seconds.observe(seconds)
+
+def observe_checksum(seconds: float) -> None:
+    """Record the time taken to verify a checksum."""
+    if _metrics is not None:
+        _metrics.checksum_seconds.observe(seconds)
+
+def count_retry() -> None:
+    """Record a failed transfer attempt that will be retried."""
+    if _metrics is not None:
+        _metrics.retries.inc()
+
+def count_file(status: str) -> None:
+    """Record a finished file with status ``ok``, ``skipped``, ``cached`` or ``failed``."""
+    if _metrics is not None:
+        _metrics.files.labels(status).inc()
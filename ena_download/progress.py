@@ -0,0 +1,239 @@
+"""
+Progress display of running downloads and logging that does not garble it.
+"""
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from .transfer import FastqFile, allocated_bytes
+
+def format_bytes(n: float) -> str:
+    """
+    Format a number of bytes with a decimal unit.
+
+    Examples
+    --------
+    >>> format_bytes(532)
+    '532 B'
+    >>> format_bytes(1536000)
+    '1.5 MB'
+    """
+    for unit in ("B", "kB", "MB", "GB", "TB"):
+        if abs(n) < 1000 or unit == "TB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1000
+    return f"{n:.1f} TB"
+
+def format_duration(seconds: Optional[float]) -> str:
+    """
+    Format a duration for display, or ``--`` if it is unknown.
+
+    Examples
+    --------
+    >>> format_duration(3725)
+    '1h02m'
+    >>> format_duration(65)
+    '1m05s'
+    >>> format_duration(None)
+    '--'
+    """
+    if seconds is None:
+        return "--"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+_display: Optional["ProgressDisplay"] = None
+"""The progress display currently shown, if any."""
+
+class ProgressDisplay:
+    """
+    Aggregated progress of all files of a batch, refreshed at a bounded rate.
+
+    Progress is measured from the size of the files on disk against their
+    ``fastq_bytes``, so it works the same for every backend and for files
+    transferred concurrently. On a terminal the display shows the files
+    currently growing and a total line with rate and ETA, and is redrawn in
+    place. Otherwise only the total line is written, every ``log_interval``
+    seconds. Completed files are no longer checked, so the cost of each
+    refresh depends only on the number of files still outstanding.
+
+    Parameters
+    ----------
+    files : Dict[str, List[FastqFile]]
+        The files of each run, as returned by :func:`resolve_accessions`.
+    interval : float
+        Seconds between refreshes. Default is 1 second.
+    stream : TextIO
+        Where the display is written. Default is ``sys.stderr``.
+    max_lines : int
+        The maximum number of files shown at once. Default is 10.
+    log_interval : float
+        Seconds between total lines when not writing to a terminal. Default is 30 seconds.
+    """
+    def __init__(self, files: Dict[str, List[FastqFile]], interval: float = 1.0, stream: Optional[TextIO] = None, max_lines: int = 10, log_interval: float = 30.0) -> None:
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stderr
+        self.max_lines = max_lines
+        self.log_interval = log_interval
+        self.tty = self.stream.isatty()
+        # [label, paths to measure, expected bytes, last measured bytes]
+        self.pending: List[List] = []
+        self.expected = 0
+        self.finished = 0
+        for run, run_files in files.items():
+            for f in run_files:
+                filename = os.path.join(run, f.filename)
+                self.expected += f.bytes or 0
+                self.pending.append([filename, [filename, filename + '.partial', filename + '.part'], f.bytes, 0])
+        self.sample()
+        self.rate: Optional[float] = None
+        self._lines = 0
+        # Serializes redraws with lines written above the display
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def sample(self) -> Tuple[int, List[Tuple[str, int, Optional[int], int]]]:
+        """
+        Measure the files that are not yet complete.
+
+        Returns
+        -------
+        tuple
+            The total number of bytes on disk, and ``(label, bytes, expected, growth)``
+            for every file that grew since the last sample.
+        """
+        active = []
+        still_pending = []
+        current = 0
+        for entry in self.pending:
+            label, paths, expected, last = entry
+            size = allocated_bytes(paths)
+            if expected is not None:
+                size = min(size, expected)
+            if size > last:
+                active.append((label, size, expected, size - last))
+            entry[3] = size
+            if expected is not None and size >= expected and os.path.exists(label):
+                self.finished += size
+            else:
+                still_pending.append(entry)
+                current += size
+        self.pending = still_pending
+        return self.finished + current, active
+
+    def render(self, done: int, active: List[Tuple[str, int, Optional[int], int]], elapsed: float) -> List[str]:
+        """
+        Build the lines of the display.
+
+        Parameters
+        ----------
+        done : int
+            The total number of bytes on disk.
+        active : list
+            The files that grew since the last sample, as returned by :meth:`sample`.
+        elapsed : float
+            Seconds since the last sample.
+
+        Returns
+        -------
+        List[str]
+            The lines to show.
+        """
+        lines = []
+        for label, size, expected, growth in active[:self.max_lines]:
+            total = format_bytes(expected) if expected is not None else "?"
+            percent = f"{100 * size / expected:5.1f}%" if expected else "    ?"
+            lines.append(f"  {label}  {format_bytes(size)} / {total}  {percent}  {format_bytes(growth / elapsed)}/s")
+        if len(active) > self.max_lines:
+            lines.append(f"  ... and {len(active) - self.max_lines} more")
+        eta = (self.expected - done) / self.rate if self.rate else None
+        percent = f"{100 * done / self.expected:.1f}%" if self.expected else "?"
+        rate = format_bytes(self.rate or 0)
+        lines.append(f"Total {format_bytes(done)} / {format_bytes(self.expected)} ({percent})  {rate}/s  ETA {format_duration(eta)}")
+        return lines
+
+    def refresh(self, elapsed: float, show: bool = True) -> None:
+        """Sample the files, update the rate and optionally redraw the display."""
+        previous = self.finished + sum(entry[3] for entry in self.pending)
+        done, active = self.sample()
+        rate = max(done - previous, 0) / elapsed if elapsed > 0 else 0.0
+        # Smooth the rate so the ETA does not jump around between refreshes
+        self.rate = rate if self.rate is None else 0.8 * self.rate + 0.2 * rate
+        if not show:
+            return
+        lines = self.render(done, active, elapsed) if self.tty else self.render(done, [], elapsed)
+        with self._lock:
+            if self.tty and self._lines:
+                self.stream.write(f"\x1b[{self._lines}A\x1b[J")
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+            self._lines = len(lines) if self.tty else 0
+
+    def write(self, message: str) -> None:
+        """Write a line in place of the display, which is drawn again below it at the next refresh."""
+        with self._lock:
+            if self.tty and self._lines:
+                self.stream.write(f"\x1b[{self._lines}A\x1b[J")
+                self._lines = 0
+            self.stream.write(message + "\n")
+            self.stream.flush()
+
+    def _run(self) -> None:
+        last = time.monotonic()
+        last_log = last
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            show = self.tty or now - last_log >= self.log_interval
+            self.refresh(now - last, show)
+            if show:
+                last_log = now
+            last = now
+
+    def start(self) -> None:
+        """Start refreshing the display in a background thread, and send :func:`log` lines to it."""
+        global _display
+        _display = self
+        self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop refreshing and show the final totals."""
+        global _display
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.refresh(self.interval)
+        if _display is self:
+            _display = None
+
+    def __enter__(self) -> "ProgressDisplay":
+        self.start()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.stop()
+
+def log(message: str, progress: bool = False) -> None:
+    """
+    Write a line to stderr without garbling a :class:`ProgressDisplay`.
+
+    While a display is shown the line is written above it, and lines that
+    only report progress are left out, as the display already shows it.
+
+    Parameters
+    ----------
+    message : str
+        The line, without a trailing newline.
+    progress : bool
+        Whether the line only reports progress, e.g. the start of a transfer.
+    """
+    display = _display
+    if display is None:
+        sys.stderr.write(message + "\n")
+    elif not progress:
+        display.write(message)
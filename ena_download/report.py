@@ -0,0 +1,170 @@
+"""
+Per-transfer metrics and machine-readable reports of a download run.
+"""
+import json
+import math
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+class TransferRecord(NamedTuple):
+    """
+    Metrics of a single file transfer.
+
+    Attributes
+    ----------
+    run : str
+        The run accession the file belongs to.
+    url : str
+        The URL of the file.
+    status : str
+        ``ok``, ``skipped`` if the file was already complete, ``cached`` if
+        it was taken from the file cache, or ``failed``.
+    bytes : int
+        The number of bytes transferred. Bytes of a partial file that was
+        resumed are not counted.
+    seconds : float
+        Wall time from the start of the first attempt to the end of the last.
+    attempts : int
+        The number of attempts made.
+    backend : str
+        The name of the transfer backend.
+    endpoint : str
+        The host the file was transferred from.
+    error : str
+        The error of the last attempt of a failed transfer, otherwise empty.
+    """
+    run: str
+    url: str
+    status: str
+    bytes: int
+    seconds: float
+    attempts: int
+    backend: str
+    endpoint: str
+    error: str = ""
+
+    @property
+    def mb_per_second(self) -> float:
+        """The transfer rate in megabytes per second."""
+        return self.bytes / self.seconds / 1e6 if self.seconds > 0 else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the record as a dictionary, including the transfer rate."""
+        record = self._asdict()
+        record["seconds"] = round(self.seconds, 3)
+        record["mb_per_second"] = round(self.mb_per_second, 3)
+        return dict(record)
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """
+    Get a percentile with the nearest-rank method.
+
+    Parameters
+    ----------
+    values : Sequence[float]
+        The values.
+    q : float
+        The percentile, between 0 and 100.
+
+    Returns
+    -------
+    float
+        The percentile, or None if there are no values.
+
+    Examples
+    --------
+    >>> percentile([15, 20, 35, 40, 50], 50)
+    35
+    >>> percentile([15, 20, 35, 40, 50], 90)
+    50
+    >>> percentile([], 50) is None
+    True
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+class RunReport:
+    """
+    Collects transfer records from all threads of a run and writes a report.
+
+    Examples
+    --------
+    >>> report = RunReport()
+    >>> report.add(TransferRecord("ERR1", "a", "ok", 2000000, 2.0, 1, "https", "ftp.sra.ebi.ac.uk"))
+    >>> report.add(TransferRecord("ERR1", "b", "failed", 0, 4.0, 3, "https", "ftp.sra.ebi.ac.uk", "timeout"))
+    >>> summary = report.summary()
+    >>> summary["files"], summary["failed"], summary["bytes"], summary["seconds_p50"]
+    (2, 1, 2000000, 2.0)
+    """
+    percentiles = (50, 90, 99)
+
+    def __init__(self) -> None:
+        self.records: List[TransferRecord] = []
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, record: TransferRecord) -> None:
+        """Add the record of a finished transfer."""
+        with self._lock:
+            self.records.append(record)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Get totals and percentiles over all transfers.
+
+        Returns
+        -------
+        Dict[str, Any]
+            Counts of files by status, total bytes and wall time, aggregate
+            rate, and percentiles of transfer time and rate over the
+            transfers that moved data.
+        """
+        with self._lock:
+            records = list(self.records)
+        elapsed = time.time() - self.started
+        total_bytes = sum(r.bytes for r in records)
+        transferred = [r for r in records if r.status == "ok"]
+        summary: Dict[str, Any] = {
+            "files": len(records),
+            "ok": len(transferred),
+            "skipped": sum(1 for r in records if r.status == "skipped"),
+            "cached": sum(1 for r in records if r.status == "cached"),
+            "failed": sum(1 for r in records if r.status == "failed"),
+            "bytes": total_bytes,
+            "seconds": round(elapsed, 3),
+            "mb_per_second": round(total_bytes / elapsed / 1e6, 3) if elapsed > 0 else 0.0,
+            "attempts": sum(r.attempts for r in records),
+        }
+        for q in self.percentiles:
+            summary[f"seconds_p{q}"] = percentile([round(r.seconds, 3) for r in transferred], q)
+            summary[f"mb_per_second_p{q}"] = percentile([round(r.mb_per_second, 3) for r in transferred], q)
+        return summary
+
+    def write(self, filename: str) -> None:
+        """
+        Write the report to a file.
+
+        Files ending in ``.ndjson`` or ``.jsonl`` get one JSON object per
+        transfer followed by a ``{"summary": ...}`` line. Other files get a
+        single JSON document with ``transfers`` and ``summary`` keys.
+
+        Parameters
+        ----------
+        filename : str
+            The file to write.
+        """
+        with self._lock:
+            records = [r.to_dict() for r in self.records]
+        summary = self.summary()
+        with open(filename, "w") as f:
+            if filename.endswith((".ndjson", ".jsonl")):
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+                f.write(json.dumps({"summary": summary}) + "\n")
+            else:
+                json.dump({"transfers": records, "summary": summary}, f, indent=2)
+                f.write("\n")
@@ -0,0 +1,295 @@
+"""
+Scheduling of concurrent transfers under a shared limit and bandwidth budget.
+"""
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+from . import metrics
+from .transfer import allocated_bytes, compute_md5
+
+class TransferScheduler:
+    """
+    Limits the number of file transfers, and their bandwidth, at any one time.
+
+    A single scheduler is shared by every download started from one
+    invocation so that the limits apply across all accessions, not per run.
+
+    When ``max_rate`` is set it is treated as a budget for all transfers
+    together. Every transfer holds ``max_rate // max_transfers`` of it, so
+    the budget always has room for as many transfers as may run at once,
+    also when the adaptive limit is raised. Transfers that can change their
+    rate while running follow :meth:`live_rate`, which adds an equal part of
+    the unallocated budget to their share, so a lone transfer uses the whole
+    budget and bandwidth freed by finished transfers is used by the ones
+    still running.
+
+    When ``adaptive`` is set the number of concurrent transfers is tuned
+    between ``min_transfers`` and ``max_transfers`` from the aggregate
+    throughput, measured every ``interval`` seconds from the growth of the
+    files being downloaded. While transfers are waiting for a slot, the limit
+    is raised by one as long as throughput keeps improving and halved when
+    throughput drops (additive increase, multiplicative decrease). It is held
+    once throughput plateaus.
+
+    Waiting transfers are given slots largest file first, so that big files
+    do not end up running alone at the end of a batch.
+
+    Parameters
+    ----------
+    max_transfers : int
+        The maximum number of concurrent transfers. Default is 2.
+    max_rate : int
+        The total bandwidth budget in kilobits per second. If not given,
+        transfers are not limited by the scheduler and each backend uses its
+        own default rate.
+    checksum_workers : int
+        The number of files whose checksums are verified at the same time.
+        Verification runs outside the transfer slots so that it overlaps with
+        the transfers that follow. Default is 2.
+    adaptive : bool
+        Tune the number of concurrent transfers from the observed throughput. Default is False.
+    min_transfers : int
+        The lower bound, and starting point, of the adaptive limit. Default is 1.
+    interval : float
+        Seconds between throughput measurements in adaptive mode. Default is 10 seconds.
+    """
+    tolerance = 0.05
+    """Relative change in throughput below which it is considered to have plateaued."""
+
+    def __init__(self, max_transfers: int = 2, max_rate: Optional[int] = None, checksum_workers: int = 2, adaptive: bool = False, min_transfers: int = 1, interval: float = 10.0) -> None:
+        if max_transfers < 1:
+            raise ValueError(f"Number of transfers must be at least 1, got {max_transfers}")
+        if not 1 <= min_transfers <= max_transfers:
+            raise ValueError(f"Minimum number of transfers must be between 1 and {max_transfers}, got {min_transfers}")
+        if max_rate is not None and max_rate < max_transfers:
+            raise ValueError(f"Rate budget of {max_rate} kbps is too small for {max_transfers} transfers")
+        self.max_transfers = max_transfers
+        self.min_transfers = min_transfers
+        self.max_rate = max_rate
+        self.adaptive = adaptive
+        self.interval = interval
+        self.limit = min_transfers if adaptive else max_transfers
+        self._lock = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        # Heap of waiting transfers, ordered by decreasing size and then arrival
+        self._queue: List = []
+        self._arrivals = itertools.count()
+        self._allocated = 0
+        self._rates: Dict[object, int] = {}
+        # The slot held by the current thread, for live_rate
+        self._local = threading.local()
+        # Files of the running transfers and their size at the last measurement
+        self._watched: Dict[object, List] = {}
+        self._finished_bytes = 0
+        self._total_bytes = 0
+        self._throughput: Optional[float] = None
+        self._controller: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._checksums = ThreadPoolExecutor(max_workers=checksum_workers, thread_name_prefix="checksum")
+
+    @contextmanager
+    def slot(self, watch_files: Sequence[str] = (), size: Optional[int] = None) -> Iterator[Optional[int]]:
+        """
+        Block until a transfer slot is free and hold it for the duration of the context.
+
+        Yields the share of the budget in kilobits per second held by the transfer,
+        or None if there is no bandwidth budget.
+
+        Parameters
+        ----------
+        watch_files : Sequence[str]
+            Files the transfer writes to, used to measure throughput in adaptive mode.
+        size : int
+            The size of the file in bytes, used to start the largest files
+            first. Files of unknown size go after all files of known size.
+        """
+        with self._lock:
+            if self.adaptive and self._controller is None:
+                self._controller = threading.Thread(target=self._control, name="transfer-controller", daemon=True)
+                self._controller.start()
+            token = object()
+            heapq.heappush(self._queue, (-(size if size is not None else -1), next(self._arrivals), token))
+            self._waiting += 1
+            while self._active >= self.limit or self._queue[0][2] is not token:
+                self._lock.wait()
+            heapq.heappop(self._queue)
+            self._waiting -= 1
+            # Let the next transfer in the queue check for a free slot
+            self._lock.notify_all()
+            self._active += 1
+            rate = self.max_rate // self.max_transfers if self.max_rate is not None else 0
+            self._allocated += rate
+            self._rates[token] = rate
+            size = allocated_bytes(watch_files)
+            self._watched[token] = [list(watch_files), size, size]
+        self._local.token = token
+        try:
+            yield rate if self.max_rate is not None else None
+        finally:
+            self._local.token = None
+            with self._lock:
+                self._rates.pop(token, None)
+                files, last, first = self._watched.pop(token)
+                size = allocated_bytes(files)
+                self._finished_bytes += max(size - last, 0)
+                self._total_bytes += max(size - first, 0)
+                self._active -= 1
+                self._allocated -= rate
+                self._lock.notify_all()
+
+    def live_rate(self) -> Callable[[], Optional[int]]:
+        """
+        Get the current rate of the slot held by this thread.
+
+        Returns
+        -------
+        Callable[[], Optional[int]]
+            A function returning the rate in kilobits per second that the
+            transfer may use right now, or None if there is no bandwidth budget.
+            It can be called from any thread until the slot is released.
+
+        Examples
+        --------
+        A lone transfer holds its share of the budget, and may use the rest
+        of it until other transfers start:
+
+        >>> scheduler = TransferScheduler(max_transfers=2, max_rate=1000)
+        >>> with scheduler.slot() as rate:
+        ...     print(rate, scheduler.live_rate()())
+        500 1000
+        """
+        token = getattr(self._local, "token", None)
+        if token is None:
+            raise RuntimeError("live_rate() must be called while holding a transfer slot")
+
+        def rate() -> Optional[int]:
+            if self.max_rate is None:
+                return None
+            with self._lock:
+                return self._rates.get(token, 0) + (self.max_rate - self._allocated) // max(self._active, 1)
+        return rate
+
+    @property
+    def active(self) -> int:
+        """The number of transfers currently running."""
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        """The number of transfers waiting for a slot."""
+        return self._waiting
+
+    def bytes_transferred(self) -> int:
+        """
+        Get the number of bytes written by all transfers so far.
+
+        Returns
+        -------
+        int
+            The bytes written by finished transfers and, so far, by running ones.
+        """
+        with self._lock:
+            total = self._total_bytes
+            for files, _, first in self._watched.values():
+                total += max(allocated_bytes(files) - first, 0)
+        return total
+
+    def measure(self) -> int:
+        """
+        Get the number of bytes written by all transfers since the last call.
+
+        Returns
+        -------
+        int
+            The number of bytes.
+        """
+        with self._lock:
+            total = self._finished_bytes
+            self._finished_bytes = 0
+            for watched in self._watched.values():
+                size = allocated_bytes(watched[0])
+                total += max(size - watched[1], 0)
+                watched[1] = size
+        return total
+
+    def adjust(self, throughput: float) -> None:
+        """
+        Update the adaptive transfer limit from a throughput measurement.
+
+        Parameters
+        ----------
+        throughput : float
+            The aggregate throughput in bytes per second over the last interval.
+
+        Examples
+        --------
+        >>> scheduler = TransferScheduler(max_transfers=8, adaptive=True)
+        >>> for throughput in [10, 20, 30, 30.5, 15]:
+        ...     scheduler._waiting = 1
+        ...     scheduler.adjust(throughput)
+        ...     print(scheduler.limit)
+        2
+        3
+        4
+        4
+        2
+        """
+        with self._lock:
+            previous = self._throughput
+            self._throughput = throughput
+            # Only probe for more concurrency when there is work waiting for a slot
+            if self._waiting == 0:
+                pass
+            elif previous is None or throughput > previous * (1 + self.tolerance):
+                self.limit = min(self.limit + 1, self.max_transfers)
+            elif throughput < previous * (1 - self.tolerance):
+                self.limit = max(self.limit // 2, self.min_transfers)
+            self._lock.notify_all()
+
+    def _control(self) -> None:
+        self.measure()
+        last = time.monotonic()
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            throughput = self.measure() / (now - last)
+            last = now
+            with self._lock:
+                idle = self._active == 0 and self._waiting == 0
+            if not idle:
+                self.adjust(throughput)
+
+    def verify(self, filename: str, md5: str) -> bool:
+        """
+        Check the MD5 checksum of a file on the checksum pool.
+
+        Parameters
+        ----------
+        filename : str
+            The file to check.
+        md5 : str
+            The expected hexadecimal MD5 digest.
+
+        Returns
+        -------
+        bool
+            True if the checksum matches.
+        """
+        def timed_md5() -> str:
+            start = time.monotonic()
+            digest = compute_md5(filename)
+            metrics.observe_checksum(time.monotonic() - start)
+            return digest
+        return self._checksums.submit(timed_md5).result() == md5
+
+    def close(self) -> None:
+        """Stop the adaptive controller and the checksum pool once all transfers have finished."""
+        self._stop.set()
+        if self._controller is not None:
+            self._controller.join()
+        self._checksums.shutdown()
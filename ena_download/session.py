@@ -0,0 +1,47 @@
+"""
+Shared HTTP session for requests to the ENA.
+"""
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+http_timeout = (10, 120)
+"""Connect and read timeouts in seconds for requests to the ENA APIs."""
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    """
+    Get the HTTP session used for all requests to the ENA APIs.
+
+    The session is created on first use and shared by all threads. It keeps
+    connections alive between requests and retries failed connections and
+    429/5xx responses with exponential backoff.
+
+    Returns
+    -------
+    requests.Session
+        The shared session.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                # The portal search queries sent with POST are read-only
+                allowed_methods=frozenset(["GET", "POST"]),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
@@ -0,0 +1,196 @@
+"""
+Streaming of fastq files to a pipe instead of a file on disk.
+"""
+import hashlib
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional, Sequence, Union
+
+try:
+    # isal decompresses gzip several times faster than zlib with the same interface
+    from isal import isal_zlib as zlib  # type: ignore
+except ImportError:
+    import zlib  # type: ignore
+
+from . import metrics
+from .transfer import ChecksumError, FastqFile, HttpsBackend, RetryPolicy, is_transient
+
+class GzipDecompressor:
+    """
+    Incrementally decompress a gzip stream.
+
+    Files made of several concatenated gzip members, as written by ``bgzip``
+    or by ``cat a.gz b.gz``, are decompressed as one stream. The ``isal``
+    package is used if it is installed, otherwise :mod:`zlib`.
+
+    Examples
+    --------
+    >>> import gzip
+    >>> data = gzip.compress(b"@r1\\nACGT\\n") + gzip.compress(b"@r2\\nTTGA\\n")
+    >>> decompressor = GzipDecompressor()
+    >>> b"".join(decompressor.decompress(data[i:i + 7]) for i in range(0, len(data), 7))
+    b'@r1\\nACGT\\n@r2\\nTTGA\\n'
+    >>> decompressor.eof
+    True
+    """
+    def __init__(self) -> None:
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data: bytes) -> bytes:
+        """Decompress the next chunk of the stream, returning whatever output is ready."""
+        output = []
+        while data:
+            output.append(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                break
+            # The rest of the chunk starts the next member
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return b"".join(output)
+
+    @property
+    def eof(self) -> bool:
+        """True if the stream ends at the end of a complete member."""
+        return self._decompressor.eof
+
+def stream_file(url: Union[str, FastqFile], decompress: bool = False, backend: Optional[HttpsBackend] = None, timeout: int = 300, rate: Optional[int] = None, retry: Optional[RetryPolicy] = None) -> Iterator[bytes]:
+    """
+    Yield the contents of a file from the ENA as it is downloaded.
+
+    Nothing is written to disk, so a pipeline can start processing a file
+    while it is still being transferred. A dropped connection is resumed
+    from the last byte received, so the stream continues without a gap.
+    The size and checksum are verified as the data passes through; as the
+    data has already been delivered when a mismatch is found, the error is
+    raised after the last chunk and the consumer should discard its output.
+
+    Parameters
+    ----------
+    url : str or FastqFile
+        The URL of the file, or the file as listed by the ENA.
+    decompress : bool
+        Yield the decompressed contents of a gzip file. Default is False.
+    backend : HttpsBackend
+        The backend the file is fetched with. Default is :class:`HttpsBackend`.
+    timeout : int
+        Seconds without data after which the connection is dropped and resumed. Default is 300 seconds.
+    rate : int
+        The maximum rate in kilobits per second, or None for no limit.
+    retry : RetryPolicy
+        How often to resume after transient failures. Default is 3 attempts.
+
+    Yields
+    ------
+    bytes
+        Chunks of the file, decompressed if ``decompress`` is True.
+
+    Raises
+    ------
+    ChecksumError
+        If the size or checksum of the file did not match.
+    EOFError
+        If ``decompress`` is True and the gzip stream was truncated.
+    TimeoutError
+        If every attempt failed with a transient error.
+    """
+    fastq_file = url if isinstance(url, FastqFile) else FastqFile(url)
+    if backend is None:
+        backend = HttpsBackend()
+    if retry is None:
+        retry = RetryPolicy()
+    md5 = hashlib.md5()
+    decompressor = GzipDecompressor() if decompress else None
+    offset = 0
+    for i in range(retry.attempts):
+        try:
+            for chunk in backend.stream(fastq_file, offset, rate, timeout):
+                offset += len(chunk)
+                md5.update(chunk)
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                if chunk:
+                    yield chunk
+            break
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            if i + 1 == retry.attempts:
+                raise TimeoutError(f"Download failed after {retry.attempts} attempts: {e!r}") from e
+            metrics.count_retry()
+            sys.stderr.write(f"Resuming {fastq_file.url} at byte {offset} after {e!r}\n")
+            time.sleep(retry.delay(i))
+
+    if fastq_file.bytes is not None and offset != fastq_file.bytes:
+        raise ChecksumError(f"Expected {fastq_file.bytes} bytes of {fastq_file.url}, received {offset}")
+    if fastq_file.md5 != "" and md5.hexdigest() != fastq_file.md5:
+        raise ChecksumError(f"Checksum mismatch for {fastq_file.url}")
+    if decompressor is not None and not decompressor.eof:
+        raise EOFError(f"Compressed stream of {fastq_file.url} ended before the end-of-stream marker")
+
+def stream_data(accession: str, files: Sequence[Union[str, FastqFile]], target: Union[str, Callable[[str, FastqFile, bytes], None]], decompress: bool = False, backend: Optional[HttpsBackend] = None, timeout: int = 300, retry: Optional[RetryPolicy] = None, rate: Optional[int] = None) -> None:
+    """
+    Stream the files of a run into pipes, files or a callback instead of the run directory.
+
+    Parameters
+    ----------
+    accession : str
+        The accession number of the run.
+    files : list of str or FastqFile
+        The files of the run.
+    target : str or callable
+        Where the data goes. ``-`` writes the files one after the other to
+        stdout. Any other string is a path template with ``{run}`` and
+        ``{filename}`` placeholders, e.g. named pipes made with ``mkfifo``
+        that an aligner reads from. The files of the run are streamed at the
+        same time, so the mates of a paired-end run can be read in lockstep.
+        A callable is called with the run, the file and every chunk, from
+        one thread per file.
+    decompress : bool
+        Deliver the decompressed contents of the files. Default is False.
+    backend : HttpsBackend
+        The backend the files are fetched with. Default is :class:`HttpsBackend`.
+    timeout : int
+        Seconds without data after which a connection is dropped and resumed. Default is 300 seconds.
+    retry : RetryPolicy
+        How often to resume after transient failures. Default is 3 attempts.
+    rate : int
+        The maximum rate in kilobits per second, shared by the files that are
+        streamed at the same time, or None for no limit.
+
+    Returns
+    -------
+    None
+    """
+    fastq_files = [f if isinstance(f, FastqFile) else FastqFile(f) for f in files]
+    file_rate = rate
+    if rate is not None and target != "-":
+        file_rate = max(rate // max(len(fastq_files), 1), 1)
+
+    def deliver(fastq_file: FastqFile) -> None:
+        chunks = stream_file(fastq_file, decompress, backend, timeout, file_rate, retry)
+        if callable(target):
+            for chunk in chunks:
+                target(accession, fastq_file, chunk)
+        elif target == "-":
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        else:
+            # Opening a named pipe blocks until its reader has opened it too
+            with open(target.format(run=accession, filename=fastq_file.filename), "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+
+    if target == "-":
+        for fastq_file in fastq_files:
+            deliver(fastq_file)
+        return None
+    with ThreadPoolExecutor(max_workers=max(len(fastq_files), 1)) as executor:
+        futures = [executor.submit(deliver, f) for f in fastq_files]
+        errors = [f.exception() for f in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+    return None
@@ -0,0 +1,643 @@
+"""
+Transfer backends that download single files from the ENA, and the checks around them.
+"""
+import errno
+import hashlib
+import json
+import os
+import random
+import signal
+import subprocess as sp
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Union
+from urllib.parse import urlparse
+
+from .session import get_session, http_timeout
+
+class FastqFile(NamedTuple):
+    """
+    A fastq file of a run as listed by the ENA.
+
+    Attributes
+    ----------
+    url : str
+        The URL of the file, without scheme.
+    md5 : str
+        The MD5 checksum of the file, or an empty string if unknown.
+    bytes : int
+        The size of the file in bytes, or None if unknown.
+    """
+    url: str
+    md5: str = ""
+    bytes: Optional[int] = None
+
+    @property
+    def filename(self) -> str:
+        """The name the file is saved under."""
+        return self.url.rstrip("/").split("/")[-1]
+
+def allocated_bytes(filenames: Iterable[str]) -> int:
+    """
+    Get the number of bytes written to disk for a set of files.
+
+    Allocated blocks are counted rather than the apparent size, so data
+    written into a preallocated sparse file is measured correctly.
+
+    Parameters
+    ----------
+    filenames : Iterable[str]
+        The files to measure. Files that do not exist are ignored.
+
+    Returns
+    -------
+    int
+        The combined number of bytes allocated to the files.
+    """
+    total = 0
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        blocks = getattr(st, "st_blocks", None)
+        total += blocks * 512 if blocks is not None else st.st_size
+    return total
+
+Rate = Union[int, Callable[[], Optional[int]], None]
+"""
+A rate in kilobits per second, None for no limit, or a function returning
+the current rate for transfers whose share changes while they run.
+"""
+
+class ChecksumError(Exception):
+    """Raised when a downloaded file does not match its expected MD5 checksum."""
+
+class PermanentTransferError(Exception):
+    """Raised when a transfer fails in a way that retrying cannot fix, e.g. a missing aspera key."""
+
+class TransferCancelled(PermanentTransferError):
+    """Raised when a transfer is stopped because it must not go on, e.g. its lease in a work queue was lost."""
+
+retry_statuses = (408, 429, 500, 502, 503, 504)
+"""HTTP statuses of failed transfers that are worth retrying."""
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Check whether a failed transfer attempt is worth retrying.
+
+    Stalled transfers, dropped connections, non-zero exits of ``ascp``,
+    checksum mismatches and the HTTP statuses in :data:`retry_statuses` are
+    transient. Other HTTP errors such as 404, missing local files or
+    programs, denied permissions and full disks are permanent.
+
+    Parameters
+    ----------
+    error : BaseException
+        The error raised by the attempt.
+
+    Returns
+    -------
+    bool
+        True if the transfer should be retried.
+
+    Examples
+    --------
+    >>> is_transient(TimeoutError("Transfer stalled"))
+    True
+    >>> is_transient(FileNotFoundError("ascp"))
+    False
+    >>> import requests
+    >>> response = requests.Response()
+    >>> response.status_code = 404
+    >>> is_transient(requests.HTTPError(response=response))
+    False
+    >>> response.status_code = 503
+    >>> is_transient(requests.HTTPError(response=response))
+    True
+    """
+    if isinstance(error, PermanentTransferError):
+        return False
+    # requests errors carry the response, aiohttp errors the status itself
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        status = getattr(error, "status", None)
+    if isinstance(status, int):
+        return status in retry_statuses
+    if isinstance(error, (FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError)):
+        return False
+    if isinstance(error, OSError) and error.errno in (errno.ENOSPC, errno.EDQUOT, errno.EROFS):
+        return False
+    return isinstance(error, (OSError, TimeoutError, ChecksumError, sp.CalledProcessError))
+
+class RetryPolicy(NamedTuple):
+    """
+    How often and how long to wait before retrying a failed transfer.
+
+    Attributes
+    ----------
+    attempts : int
+        The maximum number of attempts per file. Default is 3.
+    base_delay : float
+        The cap on the delay before the first retry in seconds. The cap
+        doubles with every retry. Default is 2 seconds.
+    max_delay : float
+        The largest delay in seconds. Default is 60 seconds.
+    """
+    attempts: int = 3
+    base_delay: float = 2.0
+    max_delay: float = 60.0
+
+    def delay(self, retry: int) -> float:
+        """
+        Get a random delay before a retry, with exponential backoff and full jitter.
+
+        The jitter spreads the retries of files that failed together, e.g.
+        when a connection to the ENA dropped, so they do not all hit the
+        server again at the same moment.
+
+        Parameters
+        ----------
+        retry : int
+            The number of the retry, starting at 0.
+
+        Returns
+        -------
+        float
+            Seconds to wait, between 0 and ``min(max_delay, base_delay * 2 ** retry)``.
+
+        Examples
+        --------
+        >>> 0 <= RetryPolicy(base_delay=1.0).delay(3) <= 8
+        True
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+def compute_md5(filename: str, chunk_size: int = 8 * 1024 * 1024) -> str:
+    """
+    Compute the MD5 checksum of a file.
+
+    Parameters
+    ----------
+    filename : str
+        The file to checksum.
+    chunk_size : int
+        The number of bytes read at a time. Default is 8 MiB.
+
+    Returns
+    -------
+    str
+        The hexadecimal MD5 digest.
+    """
+    md5 = hashlib.md5()
+    # Read into a reused buffer so large files are hashed without allocating
+    # a new chunk for every read. hashlib releases the GIL while hashing large
+    # buffers, so several files can be checked in parallel threads.
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(filename, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            md5.update(view[:n])
+    return md5.hexdigest()
+
+def run_with_watchdog(cmd: List[str], watch_files: List[str], timeout: int = 300, poll_interval: float = 1.0, cancel: Optional[threading.Event] = None) -> None:
+    """
+    Run a transfer command and kill it if it stops making progress.
+
+    The command is started in its own process group. Progress is measured
+    by the growth of ``watch_files`` on disk, so a large file that is still
+    downloading is never killed, while a stalled transfer is stopped after
+    ``timeout`` seconds without new data. The whole process group is killed
+    so no child process is left competing for bandwidth.
+
+    Parameters
+    ----------
+    cmd : List[str]
+        The command to run.
+    watch_files : List[str]
+        Files whose combined size is used to detect progress.
+    timeout : int
+        Seconds without any growth of ``watch_files`` after which the command
+        is killed. Default is 300 seconds.
+    poll_interval : float
+        Seconds between checks. Default is 1 second.
+    cancel : threading.Event
+        Event that kills the command when it is set.
+
+    Raises
+    ------
+    TimeoutError
+        If the transfer stalled.
+    TransferCancelled
+        If ``cancel`` was set.
+    subprocess.CalledProcessError
+        If the command exited with a non-zero status.
+    """
+    def watched_size() -> int:
+        total = 0
+        for f in watch_files:
+            try:
+                total += os.path.getsize(f)
+            except OSError:
+                pass
+        return total
+
+    proc = sp.Popen(cmd, start_new_session=True)
+    try:
+        last_size = watched_size()
+        last_progress = time.monotonic()
+        while True:
+            try:
+                returncode = proc.wait(timeout=poll_interval)
+                break
+            except sp.TimeoutExpired:
+                pass
+            if cancel is not None and cancel.is_set():
+                raise TransferCancelled(f"Transfer cancelled: {' '.join(cmd)}")
+            size = watched_size()
+            now = time.monotonic()
+            if size != last_size:
+                last_size = size
+                last_progress = now
+            elif now - last_progress > timeout:
+                raise TimeoutError(f"Transfer stalled for {timeout} seconds: {' '.join(cmd)}")
+    finally:
+        if proc.poll() is None:
+            kill_process_group(proc)
+    if returncode != 0:
+        raise sp.CalledProcessError(returncode, cmd)
+
+def kill_process_group(proc: "sp.Popen[bytes]", grace: float = 5.0) -> None:
+    """
+    Terminate a process started with ``start_new_session=True`` and all its children.
+
+    Parameters
+    ----------
+    proc : subprocess.Popen
+        The process to kill.
+    grace : float
+        Seconds to wait after SIGTERM before sending SIGKILL. Default is 5 seconds.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=grace)
+    except sp.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+
+class TransferBackend(ABC):
+    """
+    Base class for the methods used to transfer a file from the ENA.
+
+    Subclasses implement :meth:`transfer`, which downloads one file and
+    resumes it if a partial copy already exists.
+    """
+    name = "base"
+    endpoint = ""
+    """The host files are transferred from, used in reports."""
+    live_rate = False
+    """Whether :meth:`transfer` follows a rate that changes while the file is transferred."""
+
+    @abstractmethod
+    def transfer(self, fastq_file: FastqFile, filename: str, rate: Rate = None, timeout: int = 300, cancel: Optional[threading.Event] = None) -> None:
+        """
+        Download a single file.
+
+        Parameters
+        ----------
+        fastq_file : FastqFile
+            The file as listed by the ENA.
+        filename : str
+            The local path to write the file to.
+        rate : Rate
+            The maximum rate in kilobits per second, or None for the backend
+            default. Backends without :attr:`live_rate` call a function
+            once, when the transfer starts.
+        timeout : int
+            Seconds without progress after which the transfer is stopped.
+        cancel : threading.Event
+            Event that stops the transfer with :class:`TransferCancelled`
+            when it is set, leaving the partial file as it is.
+        """
+        raise NotImplementedError
+
+class AsperaBackend(TransferBackend):
+    """
+    Transfer files with the aspera ``ascp`` client.
+
+    Parameters
+    ----------
+    ascp : str
+        Path of the ``ascp`` binary. Default is ``~/.aspera/cli/bin/ascp``.
+    key : str
+        Path of the private key. Default is ``~/.aspera/cli/etc/asperaweb_id_dsa.openssh``.
+    quiet : bool
+        Run ``ascp`` with ``-q`` so that it does not print its own progress
+        meter, e.g. when a :class:`ProgressDisplay` is shown. Default is False.
+    """
+    name = "aspera"
+    endpoint = "fasp.sra.ebi.ac.uk"
+    default_rate = 300000
+
+    def __init__(self, ascp: Optional[str] = None, key: Optional[str] = None, quiet: bool = False) -> None:
+        home = os.path.expanduser("~")
+        self.ascp = ascp or os.path.join(home, '.aspera/cli/bin/ascp')
+        self.key = key or os.path.join(home, '.aspera/cli/etc/asperaweb_id_dsa.openssh')
+        self.quiet = quiet
+
+    def command(self, fastq_file: FastqFile, filename: str, rate: Optional[int] = None) -> List[str]:
+        """
+        Get the ``ascp`` command line that downloads a file.
+
+        Examples
+        --------
+        >>> AsperaBackend("ascp", "key").command(FastqFile("ftp.sra.ebi.ac.uk/vol1/a.fastq.gz"), "ERR1/a.fastq.gz")
+        ['ascp', '-T', '-k', '1', '-l', '300000', '-P', '33001', '-i', 'key', 'era-fasp@fasp.sra.ebi.ac.uk:vol1/a.fastq.gz', 'ERR1/']
+        """
+        path = fastq_file.url.replace('ftp.sra.ebi.ac.uk/', 'era-fasp@fasp.sra.ebi.ac.uk:')
+        rate = rate or self.default_rate
+        # -k 1 makes ascp resume partial files instead of starting over
+        return [self.ascp] + (['-q'] if self.quiet else []) + [
+            '-T', '-k', '1', '-l', str(rate), '-P', '33001', '-i', self.key,
+            path, (os.path.dirname(filename) or '.') + '/'
+        ]
+
+    def check(self) -> None:
+        """
+        Check that ``ascp`` and the key exist.
+
+        ``ascp`` exits with status 1 for most errors, so problems that a
+        retry cannot fix are caught before it is started.
+
+        Raises
+        ------
+        PermanentTransferError
+            If the binary or the key is missing.
+        """
+        for path, what in ((self.ascp, "ascp binary"), (self.key, "aspera key")):
+            if not os.path.isfile(path):
+                raise PermanentTransferError(f"The {what} was not found at {path}")
+
+    def transfer(self, fastq_file: FastqFile, filename: str, rate: Rate = None, timeout: int = 300, cancel: Optional[threading.Event] = None) -> None:
+        self.check()
+        # ascp takes its rate on the command line, so it keeps the rate it starts with
+        start_rate = rate() if callable(rate) else rate
+        run_with_watchdog(self.command(fastq_file, filename, start_rate), [filename, filename + '.partial'], timeout, cancel=cancel)
+
+class HttpsBackend(TransferBackend):
+    """
+    Transfer files over HTTPS with ``requests``.
+
+    Partial files are resumed with a Range request. This backend needs no
+    extra software and works where the aspera ports are blocked.
+
+    Large files of known size can be split into ``segments`` byte ranges
+    that are fetched over parallel connections. The segments are written
+    straight into a preallocated ``.part`` file with ``os.pwrite``, and the
+    progress of each segment is kept in a ``.segments`` file so that an
+    interrupted download resumes every segment where it stopped. The
+    ``.part`` file is renamed once all segments are complete.
+
+    Parameters
+    ----------
+    base_url : str
+        Scheme and host the file paths are fetched from. Default is
+        ``https://ftp.sra.ebi.ac.uk``. Set it to use a mirror.
+    chunk_size : int
+        The number of bytes read from the connection at a time. Default is 1 MiB.
+    segments : int
+        The maximum number of connections used for one file. Default is 1.
+    min_segment_size : int
+        Files are only split into segments of at least this many bytes.
+        Default is 64 MiB.
+    """
+    name = "https"
+    live_rate = True
+    save_interval = 5.0
+    """Seconds between saves of the progress of a segmented download."""
+
+    def __init__(self, base_url: str = "https://ftp.sra.ebi.ac.uk", chunk_size: int = 1024 * 1024, segments: int = 1, min_segment_size: int = 64 * 1024 * 1024) -> None:
+        if segments < 1:
+            raise ValueError(f"Number of segments must be at least 1, got {segments}")
+        self.base_url = base_url.rstrip("/")
+        self.endpoint = urlparse(self.base_url).netloc
+        self.chunk_size = chunk_size
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+
+    def file_url(self, fastq_file: FastqFile) -> str:
+        """
+        Get the HTTPS URL of a file.
+
+        Examples
+        --------
+        >>> HttpsBackend().file_url(FastqFile("ftp.sra.ebi.ac.uk/vol1/fastq/ERR1.fastq.gz"))
+        'https://ftp.sra.ebi.ac.uk/vol1/fastq/ERR1.fastq.gz'
+        """
+        return self.base_url + "/" + fastq_file.url.split("/", 1)[1]
+
+    def split(self, size: int) -> List[List[int]]:
+        """
+        Split a file into byte ranges.
+
+        Parameters
+        ----------
+        size : int
+            The size of the file in bytes.
+
+        Returns
+        -------
+        List[List[int]]
+            ``[start, end, done]`` for every segment, where ``end`` is inclusive
+            and ``done`` is the number of bytes already downloaded.
+
+        Examples
+        --------
+        >>> HttpsBackend(segments=3, min_segment_size=10).split(100)
+        [[0, 32, 0], [33, 65, 0], [66, 99, 0]]
+        >>> HttpsBackend(segments=3, min_segment_size=40).split(100)
+        [[0, 49, 0], [50, 99, 0]]
+        """
+        n = max(1, min(self.segments, size // self.min_segment_size))
+        bounds = [size * i // n for i in range(n + 1)]
+        return [[bounds[i], bounds[i + 1] - 1, 0] for i in range(n)]
+
+    def transfer(self, fastq_file: FastqFile, filename: str, rate: Rate = None, timeout: int = 300, cancel: Optional[threading.Event] = None) -> None:
+        if fastq_file.bytes is not None and self.segments > 1 and fastq_file.bytes >= 2 * self.min_segment_size:
+            self.transfer_segments(fastq_file, filename, rate, timeout, cancel)
+            return
+
+        offset = os.path.getsize(filename) if os.path.exists(filename) else 0
+        if fastq_file.bytes is not None and offset == fastq_file.bytes:
+            return
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+
+        # The read timeout stops a stalled connection, like the watchdog does for ascp
+        with get_session().get(self.file_url(fastq_file), headers=headers, stream=True, timeout=(http_timeout[0], timeout)) as response:
+            if response.status_code == 416:
+                # The partial file is already as large as the remote file
+                return
+            response.raise_for_status()
+            mode = "ab" if response.status_code == 206 else "wb"
+            throttle = Throttle(rate)
+            with open(filename, mode) as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if cancel is not None and cancel.is_set():
+                        raise TransferCancelled(f"Transfer of {response.url} cancelled")
+                    f.write(chunk)
+                    throttle.wait(len(chunk))
+
+    def stream(self, fastq_file: FastqFile, offset: int = 0, rate: Rate = None, timeout: int = 300) -> Iterator[bytes]:
+        """
+        Yield the bytes of a file as they arrive, without writing them to disk.
+
+        Parameters
+        ----------
+        fastq_file : FastqFile
+            The file as listed by the ENA.
+        offset : int
+            The number of bytes to skip with a Range request. Default is 0.
+        rate : Rate
+            The maximum rate in kilobits per second, or None for no limit.
+        timeout : int
+            Seconds without data after which the connection is dropped.
+
+        Yields
+        ------
+        bytes
+            Chunks of up to ``chunk_size`` bytes.
+        """
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+        with get_session().get(self.file_url(fastq_file), headers=headers, stream=True, timeout=(http_timeout[0], timeout)) as response:
+            response.raise_for_status()
+            if offset > 0 and response.status_code != 206:
+                raise IOError(f"Server does not support range requests for {response.url}")
+            throttle = Throttle(rate)
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                yield chunk
+                throttle.wait(len(chunk))
+
+    def transfer_segments(self, fastq_file: FastqFile, filename: str, rate: Rate = None, timeout: int = 300, cancel: Optional[threading.Event] = None) -> None:
+        """
+        Download a file of known size over parallel connections, one per segment.
+
+        Parameters are the same as for :meth:`transfer`.
+        """
+        assert fastq_file.bytes is not None
+        size = fastq_file.bytes
+        part = filename + ".part"
+        state_file = filename + ".segments"
+
+        segments = None
+        if os.path.exists(state_file) and os.path.exists(part):
+            with open(state_file) as f:
+                state = json.load(f)
+            if state.get("bytes") == size:
+                segments = state["segments"]
+        if segments is None:
+            segments = self.split(size)
+
+        lock = threading.Lock()
+
+        def save_state() -> None:
+            # Every segment thread saves, so the whole write and rename is done
+            # under the lock, from a temporary file no other save can touch
+            with lock:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(state_file) or ".", prefix=os.path.basename(state_file) + ".")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        json.dump({"bytes": size, "segments": segments}, f)
+                    os.replace(tmp, state_file)
+                except BaseException:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+
+        fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            save_state()
+            url = self.file_url(fastq_file)
+
+            def segment_rate() -> Optional[int]:
+                # Each connection gets an equal share of the transfer's rate
+                total = rate() if callable(rate) else rate
+                return max(total // len(segments), 1) if total else None
+
+            def fetch(segment: List[int]) -> None:
+                start, end, done = segment
+                if start + done > end:
+                    return
+                headers = {"Range": f"bytes={start + done}-{end}"}
+                with get_session().get(url, headers=headers, stream=True, timeout=(http_timeout[0], timeout)) as response:
+                    if response.status_code != 206:
+                        raise IOError(f"Server does not support range requests for {url}")
+                    throttle = Throttle(segment_rate)
+                    last_save = time.monotonic()
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        if cancel is not None and cancel.is_set():
+                            raise TransferCancelled(f"Transfer of {url} cancelled")
+                        os.pwrite(fd, chunk, start + segment[2])
+                        with lock:
+                            segment[2] += len(chunk)
+                        throttle.wait(len(chunk))
+                        if time.monotonic() - last_save > self.save_interval:
+                            save_state()
+                            last_save = time.monotonic()
+
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                futures = [executor.submit(fetch, segment) for segment in segments]
+                errors = [f.exception() for f in futures]
+        finally:
+            os.close(fd)
+            save_state()
+
+        for error in errors:
+            if error is not None:
+                raise error
+        if any(start + done <= end for start, end, done in segments):
+            raise IOError(f"Incomplete download of {url}")
+        os.replace(part, filename)
+        os.remove(state_file)
+
+class Throttle:
+    """
+    Sleeps as needed to keep a stream of bytes below a rate.
+
+    Parameters
+    ----------
+    rate : Rate
+        The maximum rate in kilobits per second, or None for no limit. A
+        function is called for every chunk, so the stream follows its changes.
+    """
+    def __init__(self, rate: Rate) -> None:
+        self.rate = rate
+        self.last = time.monotonic()
+        # Seconds by which the bytes received so far are ahead of the rate
+        self.ahead = 0.0
+
+    def wait(self, n: int) -> None:
+        """Record that ``n`` more bytes were received and sleep if ahead of the rate."""
+        rate = self.rate() if callable(self.rate) else self.rate
+        now = time.monotonic()
+        elapsed = now - self.last
+        self.last = now
+        if not rate:
+            self.ahead = 0.0
+            return
+        # The rate is in kilobits per second, 125 bytes per kilobit
+        self.ahead = max(self.ahead - elapsed, 0.0) + n / (rate * 125)
+        if self.ahead > 0:
+            time.sleep(self.ahead)
+
+backends = {backend.name: backend for backend in (AsperaBackend, HttpsBackend)}
+"""Transfer backends by name."""
@@ -0,0 +1,293 @@
+"""
+Work queue on shared storage for spreading one download over several hosts.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+class Task(NamedTuple):
+    """
+    A file to download, as handed out by :meth:`WorkQueue.lease`.
+
+    Attributes
+    ----------
+    id : int
+        The id of the task in the queue.
+    run : str
+        The run accession the file belongs to, used as the output directory.
+    url : str
+        The URL of the file.
+    md5 : str
+        The expected MD5 checksum, or empty if unknown.
+    bytes : int
+        The expected size, or None if unknown.
+    attempts : int
+        The number of times the task has been leased, including this one.
+    """
+    id: int
+    run: str
+    url: str
+    md5: str
+    bytes: Optional[int]
+    attempts: int
+
+class WorkQueue:
+    """
+    SQLite queue of per-file download tasks with expiring leases.
+
+    A coordinator adds the files of a batch with :meth:`add`. Workers on any
+    host that can open the database :meth:`lease` a task, download it and
+    :meth:`ack` it, or :meth:`release` it if the download failed. A lease
+    that is not renewed within ``lease_seconds``, e.g. because the worker
+    died, expires and the task is handed to another worker. Each task is
+    leased at most ``max_attempts`` times before it is marked failed.
+
+    Leasing happens inside an exclusive transaction, so a task is never held
+    by two workers at once. The database must be on a filesystem with
+    working POSIX locks; it does not use write-ahead logging, which needs
+    shared memory that network filesystems do not provide.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite database, created if it does not exist.
+    lease_seconds : float
+        Seconds after which a lease that was not renewed expires. Default is 10 minutes.
+    max_attempts : int
+        The number of times a task is leased before it is marked failed. Default is 3.
+    worker : str
+        Name of this worker recorded with its leases. Default is ``host:pid``.
+
+    Examples
+    --------
+    >>> queue = WorkQueue(":memory:")
+    >>> queue.add({"ERR1": [{"url": "a", "md5": "x", "bytes": 1}, {"url": "b", "md5": "y", "bytes": 2}]})
+    2
+    >>> task = queue.lease()
+    >>> task.url, task.attempts
+    ('b', 1)
+    >>> queue.ack(task)
+    True
+    >>> queue.counts()
+    {'pending': 1, 'leased': 0, 'done': 1, 'failed': 0}
+    """
+    def __init__(self, path: str, lease_seconds: float = 600.0, max_attempts: int = 3, worker: Optional[str] = None) -> None:
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        # Wait for other hosts holding the database lock instead of failing
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "id INTEGER PRIMARY KEY, run TEXT NOT NULL, url TEXT NOT NULL, "
+                "md5 TEXT NOT NULL, bytes INTEGER, state TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, expires REAL, "
+                "error TEXT, UNIQUE (run, url))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, bytes)")
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def add(self, files: Dict[str, List[Dict[str, Any]]]) -> int:
+        """
+        Add the files of a batch. Files already in the queue are left as they are.
+
+        Parameters
+        ----------
+        files : Dict[str, List[Dict[str, Any]]]
+            The files of each run, as dictionaries with ``url``, ``md5`` and ``bytes``.
+
+        Returns
+        -------
+        int
+            The number of tasks added.
+        """
+        values = [
+            (run, f["url"], f.get("md5", ""), f.get("bytes"), PENDING)
+            for run, run_files in files.items() for f in run_files
+        ]
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (run, url, md5, bytes, state) VALUES (?, ?, ?, ?, ?)",
+                values,
+            )
+            return conn.total_changes - before
+
+    def lease(self) -> Optional[Task]:
+        """
+        Lease the largest task that is pending or whose lease has expired.
+
+        Returns
+        -------
+        Task
+            The leased task, or None if no task is available right now.
+        """
+        self.expire()
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id, run, url, md5, bytes, attempts FROM tasks "
+                "WHERE state = ? OR (state = ? AND expires < ?) "
+                "ORDER BY bytes IS NULL, bytes DESC, id LIMIT 1",
+                (PENDING, LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE tasks SET state = ?, attempts = attempts + 1, worker = ?, expires = ? WHERE id = ?",
+                (LEASED, self.worker, now + self.lease_seconds, row[0]),
+            )
+        return Task(row[0], row[1], row[2], row[3], row[4], row[5] + 1)
+
+    def expire(self) -> int:
+        """
+        Mark tasks failed whose last allowed lease has expired.
+
+        Returns
+        -------
+        int
+            The number of tasks marked failed.
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE tasks SET state = ?, error = 'lease expired' "
+                "WHERE state = ? AND expires < ? AND attempts >= ?",
+                (FAILED, LEASED, time.time(), self.max_attempts),
+            ).rowcount
+
+    def _update_lease(self, task: Task, sql: str, params: Iterable[Any]) -> bool:
+        # Only the worker that still holds the lease may change the task
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                sql + " WHERE id = ? AND state = ? AND worker = ? AND attempts = ?",
+                tuple(params) + (task.id, LEASED, self.worker, task.attempts),
+            )
+            return cursor.rowcount == 1
+
+    def renew(self, task: Task) -> bool:
+        """
+        Extend the lease of a task by another ``lease_seconds``.
+
+        Returns
+        -------
+        bool
+            False if the lease was lost, e.g. because it expired and the task
+            was leased by another worker.
+        """
+        return self._update_lease(task, "UPDATE tasks SET expires = ?", (time.time() + self.lease_seconds,))
+
+    def ack(self, task: Task) -> bool:
+        """
+        Mark a leased task as done.
+
+        Returns
+        -------
+        bool
+            False if the lease was lost before the task was acknowledged.
+        """
+        return self._update_lease(task, "UPDATE tasks SET state = ?, expires = NULL, error = NULL", (DONE,))
+
+    def release(self, task: Task, error: str = "", retry: bool = True) -> bool:
+        """
+        Give up a leased task after a failed download.
+
+        Parameters
+        ----------
+        task : Task
+            The leased task.
+        error : str
+            The error of the download, kept for :meth:`failures`.
+        retry : bool
+            If True, the task goes back to the queue unless it has already
+            been leased ``max_attempts`` times. Otherwise it is marked failed.
+
+        Returns
+        -------
+        bool
+            False if the lease was lost before the task was released.
+        """
+        state = PENDING if retry and task.attempts < self.max_attempts else FAILED
+        return self._update_lease(task, "UPDATE tasks SET state = ?, expires = NULL, error = ?", (state, error))
+
+    @contextmanager
+    def hold(self, task: Task) -> Iterator[threading.Event]:
+        """
+        Keep renewing the lease of a task in the background while the block runs.
+
+        The lease is renewed every third of ``lease_seconds``, so a long
+        transfer keeps its lease while a dead worker loses it.
+
+        Yields an event that is set once the lease is lost, either because
+        another worker took over the task or because it could not be renewed
+        before it expired. The block should then stop working on the task.
+        """
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def renew() -> None:
+            expires = time.monotonic() + self.lease_seconds
+            while not stop.wait(self.lease_seconds / 3):
+                now = time.monotonic()
+                try:
+                    if self.renew(task):
+                        expires = now + self.lease_seconds
+                        continue
+                    lost.set()
+                    return
+                except sqlite3.Error:
+                    # E.g. the database stayed locked; try again while the lease lasts
+                    if time.monotonic() > expires:
+                        lost.set()
+                        return
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            thread.join()
+
+    def counts(self) -> Dict[str, int]:
+        """Get the number of tasks in each state."""
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        with self._lock:
+            for state, n in self._conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state"):
+                counts[state] = n
+        return counts
+
+    def failures(self) -> List[Tuple[Task, str]]:
+        """Get the tasks that failed permanently or ran out of attempts, with their last error."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, run, url, md5, bytes, attempts, error FROM tasks WHERE state = ? ORDER BY id",
+                (FAILED,),
+            ).fetchall()
+        return [(Task(*row[:6]), row[6] or "") for row in rows]
+
+    def close(self) -> None:
+        """Close the underlying database connection."""
+        with self._lock:
+            self._conn.close()
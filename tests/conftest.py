@@ -0,0 +1,113 @@
+import io
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+import ena_download.session
+
+class RangeServer:
+    """HTTP server on localhost that serves files from memory and honours Range requests."""
+    def __init__(self) -> None:
+        self.files: Dict[str, bytes] = {}
+        # Range header of every request, or None if it had none
+        self.ranges: List[str] = []
+        self.support_ranges = True
+        # Error status to answer a path with instead of its file
+        self.statuses: Dict[str, int] = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                data = server.files.get(self.path)
+                header = self.headers.get("Range")
+                server.ranges.append(header)
+                if self.path in server.statuses:
+                    self.send_error(server.statuses[self.path])
+                    return
+                if data is None:
+                    self.send_error(404)
+                    return
+                match = re.match(r"bytes=(\d+)-(\d*)$", header or "")
+                if not server.support_ranges or match is None:
+                    self.send_response(200)
+                    body = data
+                else:
+                    start = int(match.group(1))
+                    end = int(match.group(2)) if match.group(2) else len(data) - 1
+                    if start >= len(data):
+                        self.send_error(416)
+                        return
+                    body = data[start:end + 1]
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{start + len(body) - 1}/{len(data)}")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args: object) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest.fixture
+def range_server():
+    server = RangeServer()
+    yield server
+    server.close()
+
+class Portal(BaseAdapter):
+    """Answers ENA portal API queries from canned filereport rows."""
+    def __init__(self) -> None:
+        super().__init__()
+        # Rows of the runs each accession resolves to, as run, fastq_ftp, fastq_md5 and fastq_bytes
+        self.rows: Dict[str, List[str]] = {}
+        # Status of the queries that include an accession, if not 200
+        self.statuses: Dict[str, int] = {}
+        # Accessions of every query
+        self.queries: List[List[str]] = []
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        if url.path.endswith("/search"):
+            accessions = parse_qs(request.body)["includeAccessions"][0].split(",")
+        else:
+            accessions = parse_qs(url.query)["accession"]
+        self.queries.append(accessions)
+        response = requests.Response()
+        response.url = request.url
+        response.request = request
+        response.status_code = next((self.statuses[a] for a in accessions if a in self.statuses), 200)
+        body = ""
+        if response.status_code == 200:
+            rows = [row for a in accessions for row in self.rows.get(a, [])]
+            body = "".join(f"{row}\n" for row in ["run_accession\tfastq_ftp\tfastq_md5\tfastq_bytes"] + rows)
+        response.raw = io.BytesIO(body.encode())
+        response.encoding = "utf-8"
+        return response
+
+    def close(self) -> None:
+        pass
+
+@pytest.fixture
+def portal(monkeypatch):
+    """Replace the ENA portal API of the shared session with a :class:`Portal`."""
+    portal = Portal()
+    session = requests.Session()
+    session.mount("https://www.ebi.ac.uk/", portal)
+    session.mount("http://", HTTPAdapter())
+    monkeypatch.setattr(ena_download.session, "_session", session)
+    yield portal
+    session.close()
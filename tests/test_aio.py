@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import os
+import time
+
+import aiohttp
+import pytest
+
+from ena_download import FastqFile, FilereportRecord, HttpsBackend, aio
+
+def fetch(url, retries=0):
+    async def run():
+        async with aio.client_session() as session:
+            return await aio.fetch_text(session, url, retries=retries)
+    return asyncio.run(run())
+
+def test_fetch_tells_unknown_accessions_from_errors(range_server):
+    range_server.files["/report"] = b"run_accession\n"
+    range_server.statuses["/unknown"] = 400
+    range_server.statuses["/overloaded"] = 503
+    assert fetch(range_server.url + "/report") == "run_accession\n"
+    assert fetch(range_server.url + "/unknown") is None
+    with pytest.raises(aiohttp.ClientResponseError) as error:
+        fetch(range_server.url + "/overloaded", retries=1)
+    assert error.value.status == 503
+    # The overloaded portal was asked again before giving up
+    assert len(range_server.ranges) == 4
+
+content = os.urandom(200 * 1024)
+
+def fastq_file(run):
+    return FastqFile(f"ftp.sra.ebi.ac.uk/vol1/{run}_1.fastq.gz", hashlib.md5(content).hexdigest(), len(content))
+
+def fake_portal(monkeypatch, expansions):
+    """Answer the queries of aio with the runs that each accession expands into."""
+    queries = []
+
+    async def fetch_records(session, url, data=None, retries=5):
+        accessions = data["includeAccessions"].split(",") if data else [url.split("accession=")[1].split("&")[0]]
+        queries.append(accessions)
+        runs = [run for a in accessions for run in expansions.get(a, [])]
+        return [FilereportRecord.from_columns(run, *fastq_file(run)[:2], str(len(content))) for run in runs]
+
+    monkeypatch.setattr(aio, "fetch_records", fetch_records)
+    return queries
+
+def test_resolve_queries_runs_in_chunks_and_expands_the_rest(monkeypatch):
+    queries = fake_portal(monkeypatch, {"ERR1000001": ["ERR1000001"], "ERR1000002": ["ERR1000002"], "PRJEB1": ["ERR2000001", "ERR2000002"]})
+    files = asyncio.run(aio.resolve(["ERR1000001", "ERR1000002", "PRJEB1", "PRJEB2", "bad"], chunk_size=1))
+    assert sorted(files) == ["ERR1000001", "ERR1000002", "ERR2000001", "ERR2000002"]
+    assert files["ERR2000001"] == [fastq_file("ERR2000001")]
+    # The malformed accession is not queried
+    assert sorted(queries) == [["ERR1000001"], ["ERR1000002"], ["PRJEB1"], ["PRJEB2"]]
+
+def test_download_resumes_and_verifies(range_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    range_server.files["/vol1/ERR1000001_1.fastq.gz"] = content
+    os.makedirs("ERR1000001")
+    with open(os.path.join("ERR1000001", "ERR1000001_1.fastq.gz"), "wb") as f:
+        f.write(content[:1000])
+    asyncio.run(aio.download("ERR1000001", [fastq_file("ERR1000001")], backend=HttpsBackend(range_server.url)))
+    assert range_server.ranges == ["bytes=1000-"]
+    assert open(os.path.join("ERR1000001", "ERR1000001_1.fastq.gz"), "rb").read() == content
+
+def test_download_many_reports_failures(range_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fake_portal(monkeypatch, {"PRJEB1": ["ERR2000001", "ERR2000002"]})
+    range_server.files["/vol1/ERR2000001_1.fastq.gz"] = content
+    range_server.files["/vol1/ERR2000002_1.fastq.gz"] = content[:-1]
+    failed = asyncio.run(aio.download_many(["PRJEB1", "PRJEB2"], backend=HttpsBackend(range_server.url)))
+    # The truncated file fails its checksum on every attempt
+    assert failed == ["PRJEB2", "ERR2000002"]
+    assert open(os.path.join("ERR2000001", "ERR2000001_1.fastq.gz"), "rb").read() == content
+
+def test_watchdog_kills_stalled_command(tmp_path):
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        asyncio.run(aio.run_with_watchdog(["sleep", "60"], [str(tmp_path / "never")], timeout=1, poll_interval=0.1))
+    assert time.monotonic() - start < 10
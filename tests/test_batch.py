@@ -0,0 +1,28 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import ena_download
+from ena_download import FastqFile, HttpsBackend, main_many
+
+content = os.urandom(300 * 1024)
+
+def test_interrupt_stops_the_batch(range_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = {}
+    for run in ["ERR1000001", "ERR1000002", "ERR1000003"]:
+        range_server.files[f"/vol1/{run}_1.fastq.gz"] = content
+        files[run] = [FastqFile(f"ftp.sra.ebi.ac.uk/vol1/{run}_1.fastq.gz", "", len(content))]
+    monkeypatch.setattr(ena_download, "resolve_batch", lambda accessions, cache=None, journal=None: (files, []))
+    threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGINT)).start()
+    start = time.monotonic()
+    # 400 kbps takes 6 seconds for each file
+    with pytest.raises(KeyboardInterrupt):
+        main_many(list(files), max_rate=400, transfers=1, backend=HttpsBackend(range_server.url, chunk_size=4096))
+    assert time.monotonic() - start < 3
+    assert os.path.getsize(str(tmp_path / "ERR1000001" / "ERR1000001_1.fastq.gz")) < len(content)
+    # The runs that had not started are dropped
+    assert sorted(os.listdir(str(tmp_path))) == ["ERR1000001"]
@@ -0,0 +1,63 @@
+import sqlite3
+
+import ena_download.cache
+from ena_download import resolve_accessions
+from ena_download.cache import MetadataCache
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+def row(run):
+    return {"run_accession": run, "fastq_ftp": f"ftp.sra.ebi.ac.uk/vol1/{run}_1.fastq.gz", "fastq_md5": "x", "fastq_bytes": "10"}
+
+def test_entries_expire_after_ttl(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ena_download.cache, "time", clock)
+    cache = MetadataCache(str(tmp_path / "cache.sqlite"), ttl=100)
+    cache.put_rows([row("ERR1000001")])
+    cache.put_expansion("PRJEB1", ["ERR1000001"])
+    clock.now += 50
+    assert cache.get_rows(["ERR1000001", "ERR1000002"]) == {"ERR1000001": row("ERR1000001")}
+    assert cache.get_expansion("PRJEB1") == ["ERR1000001"]
+    clock.now += 51
+    assert cache.get_rows(["ERR1000001"]) == {}
+    assert cache.get_expansion("PRJEB1") is None
+    cache.evict()
+    cache.close()
+    conn = sqlite3.connect(str(tmp_path / "cache.sqlite"))
+    assert conn.execute("SELECT COUNT(*) FROM runs").fetchone() == (0,)
+    assert conn.execute("SELECT COUNT(*) FROM expansions").fetchone() == (0,)
+    conn.close()
+
+def test_evict_keeps_the_newest_entries(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ena_download.cache, "time", clock)
+    cache = MetadataCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    runs = [f"ERR100000{i}" for i in range(4)]
+    for run in runs:
+        cache.put_rows([row(run)])
+        clock.now += 1
+    cache.evict()
+    assert sorted(cache.get_rows(runs)) == runs[2:]
+    cache.close()
+
+def test_refresh_ignores_cached_entries(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = MetadataCache(path)
+    cache.put_rows([row("ERR1000001")])
+    cache.close()
+    cache = MetadataCache(path, refresh=True)
+    assert cache.get_rows(["ERR1000001"]) == {}
+    cache.close()
+
+def test_cached_runs_are_not_queried_again(tmp_path, portal):
+    portal.rows["ERR1000001"] = ["ERR1000001\tftp.sra.ebi.ac.uk/vol1/ERR1000001_1.fastq.gz\tx\t10"]
+    cache = MetadataCache(str(tmp_path / "cache.sqlite"))
+    first = resolve_accessions(["ERR1000001"], cache=cache)
+    assert resolve_accessions(["ERR1000001"], cache=cache) == first
+    assert portal.queries == [["ERR1000001"]]
+    cache.close()
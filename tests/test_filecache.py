@@ -0,0 +1,38 @@
+import hashlib
+import os
+
+from ena_download import FastqFile, HttpsBackend, TransferScheduler, download_file
+from ena_download.filecache import FileCache
+
+def add(cache, tmp_path, data, mtime):
+    md5 = hashlib.md5(data).hexdigest()
+    filename = str(tmp_path / f"{md5}.fastq.gz")
+    with open(filename, "wb") as f:
+        f.write(data)
+    assert cache.put(md5, filename)
+    os.utime(cache.object_path(md5), (mtime, mtime))
+    return md5
+
+def test_least_recently_used_files_are_evicted_over_quota(tmp_path):
+    cache = FileCache(str(tmp_path / "cache"), quota=250)
+    first = add(cache, tmp_path, b"a" * 100, 1000)
+    second = add(cache, tmp_path, b"b" * 100, 2000)
+    # Using the first file makes the second one the least recently used
+    assert cache.get(first, str(tmp_path / "used.fastq.gz"))
+    third = add(cache, tmp_path, b"c" * 100, 3000)
+    assert os.path.exists(cache.object_path(first))
+    assert not os.path.exists(cache.object_path(second))
+    assert os.path.exists(cache.object_path(third))
+    assert sum(size for _, size, _ in cache.entries()) == 200
+
+def test_cached_file_is_not_downloaded(range_server, tmp_path):
+    data = os.urandom(1000)
+    cache = FileCache(str(tmp_path / "cache"))
+    md5 = add(cache, tmp_path, data, 1000)
+    fastq_file = FastqFile("ftp.sra.ebi.ac.uk/vol1/ERR1_1.fastq.gz", md5, len(data))
+    os.makedirs(str(tmp_path / "ERR1"))
+    scheduler = TransferScheduler()
+    download_file(fastq_file, str(tmp_path / "ERR1"), scheduler=scheduler, backend=HttpsBackend(range_server.url), file_cache=cache)
+    scheduler.close()
+    assert range_server.ranges == []
+    assert open(str(tmp_path / "ERR1" / "ERR1_1.fastq.gz"), "rb").read() == data
@@ -0,0 +1,62 @@
+import ena_download
+from ena_download import resolve_batch
+from ena_download.journal import DOWNLOADED, TRANSFERRING, VERIFIED, Journal
+
+files = {"ERR1": [{"url": "a", "md5": "x", "bytes": 1}, {"url": "b", "md5": "y", "bytes": 2}]}
+
+def test_replay_restores_state(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.record_resolved("PRJEB1", files)
+    journal.set_state("ERR1", "a", TRANSFERRING)
+    journal.set_state("ERR1", "a", VERIFIED)
+    journal.set_state("ERR1", "b", DOWNLOADED)
+    journal.close()
+
+    journal = Journal(path, resume=True)
+    assert journal.resolved == {"PRJEB1": ["ERR1"]}
+    assert journal.files == files
+    assert journal.state("ERR1", "a") == VERIFIED
+    assert journal.state("ERR1", "b") == DOWNLOADED
+    journal.close()
+
+def test_without_resume_the_journal_starts_over(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.set_state("ERR1", "a", VERIFIED)
+    journal.close()
+    journal = Journal(path)
+    assert journal.state("ERR1", "a") is None
+    journal.close()
+    assert open(path).read() == ""
+
+def test_torn_last_line_is_dropped_before_appending(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.set_state("ERR1", "a", TRANSFERRING)
+    journal.close()
+    # The process died halfway through writing an event
+    with open(path, "a") as f:
+        f.write('{"run": "ERR1", "url": "a", "sta')
+
+    journal = Journal(path, resume=True)
+    assert journal.state("ERR1", "a") == TRANSFERRING
+    journal.set_state("ERR1", "a", VERIFIED)
+    journal.close()
+
+    journal = Journal(path, resume=True)
+    assert journal.state("ERR1", "a") == VERIFIED
+    journal.close()
+    assert len(open(path).read().splitlines()) == 2
+
+def test_accession_without_runs_is_invalid_on_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(ena_download, "iter_filereport_pages", lambda accession, cache=None: iter([]))
+    path = str(tmp_path / "journal.jsonl")
+    for resume in (False, True):
+        journal = Journal(path, resume=resume)
+        files, invalid = resolve_batch(["PRJEB1"], journal=journal)
+        journal.close()
+        assert (files, invalid) == ({}, ["PRJEB1"])
+    journal = Journal(path, resume=True)
+    assert journal.resolved == {}
+    journal.close()
@@ -0,0 +1,46 @@
+import os
+import socket
+
+import requests
+
+from ena_download import FastqFile, HttpsBackend, TransferScheduler, download_file, metrics
+
+content = os.urandom(100 * 1024)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def sample(text, name):
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[-1])
+    return None
+
+def test_functions_do_nothing_without_server(monkeypatch):
+    monkeypatch.setattr(metrics, "_metrics", None)
+    metrics.count_retry()
+    metrics.count_file("ok")
+    metrics.observe_metadata_query(1.0)
+    metrics.register_scheduler(TransferScheduler())
+    assert metrics._metrics is None
+
+def test_server_reports_transfers(range_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "_metrics", None)
+    port = free_port()
+    metrics.start_server(port, addr="127.0.0.1")
+    range_server.files["/vol1/ERR1_1.fastq.gz"] = content
+    scheduler = TransferScheduler(max_transfers=3)
+    metrics.register_scheduler(scheduler)
+    fastq_file = FastqFile("ftp.sra.ebi.ac.uk/vol1/ERR1_1.fastq.gz", "", len(content))
+    download_file(fastq_file, str(tmp_path), scheduler=scheduler, backend=HttpsBackend(range_server.url))
+    metrics.count_retry()
+    scheduler.close()
+
+    text = requests.get(f"http://127.0.0.1:{port}/metrics").text
+    assert sample(text, 'ena_download_files_total{status="ok"}') == 1
+    assert sample(text, "ena_download_retries_total") == 1
+    assert sample(text, "ena_download_bytes_total") == len(content)
+    assert sample(text, "ena_download_active_transfers") == 0
+    assert sample(text, "ena_download_transfer_limit") == 3
@@ -0,0 +1,59 @@
+import io
+import os
+
+from ena_download import FastqFile, ProgressDisplay, log
+
+class Terminal(io.StringIO):
+    def isatty(self):
+        return True
+
+# Progress is measured from allocated blocks, so the sizes are whole blocks
+block = 64 * 1024
+files = {
+    "ERR1": [FastqFile("ftp.sra.ebi.ac.uk/vol1/ERR1_1.fastq.gz", "", block), FastqFile("ftp.sra.ebi.ac.uk/vol1/ERR1_2.fastq.gz", "", 3 * block)],
+}
+
+def write(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+
+def test_total_counts_the_files_on_disk(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write("ERR1/ERR1_1.fastq.gz", block)
+    write("ERR1/ERR1_2.fastq.gz.partial", block)
+    stream = io.StringIO()
+    display = ProgressDisplay(files, stream=stream)
+    # The complete file is no longer checked
+    assert [entry[0] for entry in display.pending] == [os.path.join("ERR1", "ERR1_2.fastq.gz")]
+    write("ERR1/ERR1_2.fastq.gz.partial", 2 * block)
+    display.refresh(1.0)
+    assert stream.getvalue() == "Total 196.6 kB / 262.1 kB (75.0%)  65.5 kB/s  ETA 0m01s\n"
+
+def test_terminal_display_is_redrawn_in_place(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    stream = Terminal()
+    display = ProgressDisplay(files, stream=stream)
+    write("ERR1/ERR1_2.fastq.gz.partial", block)
+    display.refresh(1.0)
+    lines = stream.getvalue().splitlines()
+    assert lines[0] == "  " + os.path.join("ERR1", "ERR1_2.fastq.gz") + "  65.5 kB / 196.6 kB   33.3%  65.5 kB/s"
+    assert lines[1].startswith("Total 65.5 kB / 262.1 kB (25.0%)")
+    stream.seek(0)
+    stream.truncate()
+    display.refresh(1.0)
+    # The two lines drawn before are cleared first
+    assert stream.getvalue().startswith("\x1b[2A\x1b[J")
+
+def test_log_writes_above_the_display(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    stream = Terminal()
+    with ProgressDisplay(files, stream=stream, interval=60) as display:
+        display.refresh(1.0)
+        stream.seek(0)
+        stream.truncate()
+        log("Checksum mismatch")
+        log("Attempt 1 at downloading", progress=True)
+        assert stream.getvalue() == "\x1b[1A\x1b[JChecksum mismatch\n"
+    log("After the display")
+    assert capsys.readouterr().err == "After the display\n"
@@ -0,0 +1,67 @@
+import pytest
+import requests
+
+from ena_download import FastqFile, MetadataCache, fetch_filereport, iter_filereport_pages, resolve_accessions, resolve_batch
+
+def run_row(run):
+    return f"{run}\tftp.sra.ebi.ac.uk/vol1/{run}_1.fastq.gz\tx\t10"
+
+def test_runs_are_resolved_in_chunks(portal):
+    runs = [f"ERR100000{i}" for i in range(5)]
+    for run in runs:
+        portal.rows[run] = [run_row(run)]
+    files = resolve_accessions(runs, chunk_size=2)
+    assert portal.queries == [runs[0:2], runs[2:4], runs[4:]]
+    assert files["ERR1000003"] == [FastqFile("ftp.sra.ebi.ac.uk/vol1/ERR1000003_1.fastq.gz", "x", 10)]
+    assert sorted(files) == runs
+
+def test_failed_chunk_does_not_stop_the_batch(portal):
+    runs = [f"ERR100000{i}" for i in range(4)]
+    for run in runs:
+        portal.rows[run] = [run_row(run)]
+    portal.statuses["ERR1000000"] = 500
+    assert sorted(resolve_accessions(runs, chunk_size=2)) == runs[2:]
+
+    portal.rows["PRJEB1"] = [run_row("ERR2000001")]
+    files, invalid = resolve_batch(runs + ["PRJEB1", "ERR1"])
+    assert sorted(files) == ["ERR2000001"]
+    # The malformed accession is reported without a query
+    assert invalid == runs + ["ERR1"]
+
+def test_only_unknown_accession_statuses_mean_no_runs(portal):
+    portal.statuses["PRJEB1"] = 404
+    portal.statuses["PRJEB2"] = 503
+    assert fetch_filereport("PRJEB1") == []
+    with pytest.raises(requests.HTTPError):
+        fetch_filereport("PRJEB2")
+
+    files, invalid = resolve_batch(["PRJEB1", "PRJEB2", "PRJEB3"])
+    assert (files, invalid) == ({}, ["PRJEB1", "PRJEB2", "PRJEB3"])
+
+def test_runs_without_fastq_files_fail(portal):
+    portal.rows["ERR1000001"] = ["ERR1000001\t\t\t"]
+    portal.rows["PRJEB1"] = [run_row("ERR2000001"), "ERR2000002\t\t\t"]
+    files, invalid = resolve_batch(["ERR1000001", "PRJEB1"])
+    assert list(files) == ["ERR2000001"]
+    assert invalid == ["ERR1000001", "ERR2000002"]
+
+def test_project_is_expanded_page_by_page(portal, tmp_path):
+    runs = [f"ERR200000{i}" for i in range(5)]
+    portal.rows["PRJEB1"] = [run_row(run) for run in runs]
+    cache = MetadataCache(str(tmp_path / "cache.sqlite"))
+    pages = [[r.run_accession for r in page] for page in iter_filereport_pages("PRJEB1", cache, page_size=2)]
+    assert pages == [runs[0:2], runs[2:4], runs[4:]]
+    assert cache.get_expansion("PRJEB1") == runs
+    # The second expansion is read from the cache
+    assert [len(page) for page in iter_filereport_pages("PRJEB1", cache, page_size=2)] == [2, 2, 1]
+    assert len(portal.queries) == 1
+    cache.close()
+
+def test_batch_hands_out_runs_as_they_are_resolved(portal):
+    portal.rows["ERR1000001"] = [run_row("ERR1000001")]
+    portal.rows["PRJEB1"] = [run_row("ERR2000001"), run_row("ERR2000002")]
+    pages = []
+    files, invalid = resolve_batch(["ERR1000001", "PRJEB1"], on_files=lambda page: pages.append(sorted(page)))
+    assert pages == [["ERR1000001"], ["ERR2000001", "ERR2000002"]]
+    assert sorted(files) == ["ERR1000001", "ERR2000001", "ERR2000002"]
+    assert invalid == []
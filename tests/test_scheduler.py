@@ -0,0 +1,119 @@
+import random
+import threading
+import time
+
+from ena_download import TransferScheduler
+
+def test_lone_transfer_holds_its_share():
+    scheduler = TransferScheduler(max_transfers=4, max_rate=1000)
+    with scheduler.slot() as rate:
+        assert rate == 250
+        assert scheduler.live_rate()() == 1000
+    scheduler.close()
+
+def test_later_transfers_start_next_to_running_ones():
+    scheduler = TransferScheduler(max_transfers=2, max_rate=1000)
+    started = threading.Event()
+    finish = threading.Event()
+
+    def first():
+        with scheduler.slot():
+            started.set()
+            finish.wait()
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    started.wait()
+    # The second transfer arrives after the first one started
+    with scheduler.slot() as rate:
+        assert scheduler.active == 2
+        assert rate == 500
+    finish.set()
+    thread.join()
+    scheduler.close()
+
+def test_raised_adaptive_limit_starts_waiting_transfer():
+    scheduler = TransferScheduler(max_transfers=4, max_rate=1000, adaptive=True, interval=60)
+    started = threading.Event()
+    finish = threading.Event()
+    rates = []
+
+    def transfer():
+        with scheduler.slot() as rate:
+            rates.append(rate)
+            started.set()
+            finish.wait()
+
+    first = threading.Thread(target=transfer)
+    first.start()
+    started.wait()
+    started.clear()
+    second = threading.Thread(target=transfer)
+    second.start()
+    while scheduler.waiting == 0:
+        time.sleep(0.01)
+    scheduler.adjust(1e9)
+    assert started.wait(2)
+    assert scheduler.active == 2
+    finish.set()
+    first.join()
+    second.join()
+    scheduler.close()
+    assert rates == [250, 250]
+
+def test_rates_stay_within_budget_and_above_zero():
+    scheduler = TransferScheduler(max_transfers=4, max_rate=1000, adaptive=True, interval=0.05)
+    rates = []
+    peak = [0]
+    lock = threading.Lock()
+
+    def transfer():
+        time.sleep(random.random() * 0.1)
+        with scheduler.slot(size=random.randint(1, 100)) as rate:
+            with lock:
+                rates.append(rate)
+                peak[0] = max(peak[0], sum(scheduler._rates.values()))
+            time.sleep(random.random() * 0.05)
+
+    threads = [threading.Thread(target=transfer) for _ in range(40)]
+    for thread in threads:
+        thread.start()
+    # Raise the limit while transfers are running
+    for throughput in range(1, 5):
+        scheduler.adjust(throughput * 1e9)
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    scheduler.close()
+    assert len(rates) == 40
+    assert min(rates) >= 1000 // 4
+    assert peak[0] <= 1000
+
+def test_live_rate_follows_freed_bandwidth():
+    scheduler = TransferScheduler(max_transfers=2, max_rate=1000)
+    started = threading.Event()
+    finish = threading.Event()
+
+    def other():
+        with scheduler.slot():
+            started.set()
+            finish.wait()
+
+    with scheduler.slot():
+        live = scheduler.live_rate()
+        assert live() == 1000
+        thread = threading.Thread(target=other)
+        thread.start()
+        started.wait()
+        assert live() == 500
+        finish.set()
+        thread.join()
+        assert live() == 1000
+    scheduler.close()
+
+def test_close_stops_controller():
+    scheduler = TransferScheduler(adaptive=True, interval=0.05)
+    with scheduler.slot():
+        pass
+    scheduler.close()
+    assert not any(t.name == "transfer-controller" for t in threading.enumerate())
@@ -0,0 +1,39 @@
+import json
+import os
+
+from ena_download import FastqFile, HttpsBackend
+
+content = os.urandom(300 * 1024)
+fastq_file = FastqFile("ftp.sra.ebi.ac.uk/vol1/ERR1_1.fastq.gz", "", len(content))
+
+def test_segments_resume_where_they_stopped(range_server, tmp_path):
+    range_server.files["/vol1/ERR1_1.fastq.gz"] = content
+    filename = str(tmp_path / "ERR1_1.fastq.gz")
+    backend = HttpsBackend(range_server.url, segments=3, min_segment_size=64 * 1024)
+    segments = backend.split(len(content))
+    # Each segment is partly downloaded, the last one not at all
+    with open(filename + ".part", "wb") as f:
+        f.write(b"\0" * len(content))
+        for segment, done in zip(segments, (100, 5000, 0)):
+            f.seek(segment[0])
+            f.write(content[segment[0]:segment[0] + done])
+            segment[2] = done
+    with open(filename + ".segments", "w") as f:
+        json.dump({"bytes": len(content), "segments": segments}, f)
+
+    backend.transfer(fastq_file, filename)
+    assert sorted(range_server.ranges) == sorted(
+        f"bytes={start + done}-{end}" for start, end, done in segments
+    )
+    assert open(filename, "rb").read() == content
+    assert os.listdir(str(tmp_path)) == ["ERR1_1.fastq.gz"]
+
+def test_segment_state_saved_from_many_threads(range_server, tmp_path):
+    range_server.files["/vol1/ERR1_1.fastq.gz"] = content
+    filename = str(tmp_path / "ERR1_1.fastq.gz")
+    backend = HttpsBackend(range_server.url, chunk_size=256, segments=16, min_segment_size=1024)
+    # Every chunk of every segment saves the state
+    backend.save_interval = 0
+    backend.transfer(fastq_file, filename)
+    assert open(filename, "rb").read() == content
+    assert os.listdir(str(tmp_path)) == ["ERR1_1.fastq.gz"]
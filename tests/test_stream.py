@@ -0,0 +1,72 @@
+import gzip
+import hashlib
+import os
+import sys
+
+import pytest
+
+from ena_download import ChecksumError, FastqFile, HttpsBackend, RetryPolicy, cli, stream_data, stream_file
+
+content = os.urandom(300 * 1024)
+fastq_file = FastqFile("ftp.sra.ebi.ac.uk/vol1/ERR1_1.fastq.gz", hashlib.md5(content).hexdigest(), len(content))
+
+class DroppingBackend(HttpsBackend):
+    """Drops the first connection after ``drop_at`` bytes and records the offset and rate of every request."""
+    def __init__(self, base_url, drop_at=None, **kwargs):
+        super().__init__(base_url, **kwargs)
+        self.drop_at = drop_at
+        self.offsets = []
+        self.rates = []
+
+    def stream(self, fastq_file, offset=0, rate=None, timeout=300):
+        self.offsets.append(offset)
+        self.rates.append(rate)
+        received = 0
+        for chunk in super().stream(fastq_file, offset, rate, timeout):
+            yield chunk
+            received += len(chunk)
+            if len(self.offsets) == 1 and received == self.drop_at:
+                raise ConnectionError("Connection reset")
+
+def test_stream_resumes_after_dropped_connection(range_server):
+    range_server.files["/vol1/ERR1_1.fastq.gz"] = content
+    backend = DroppingBackend(range_server.url, drop_at=100 * 1024, chunk_size=4096)
+    data = b"".join(stream_file(fastq_file, backend=backend, retry=RetryPolicy(base_delay=0)))
+    assert data == content
+    assert range_server.ranges == [None, f"bytes={100 * 1024}-"]
+
+def test_stream_checks_the_checksum_after_the_last_chunk(range_server):
+    range_server.files["/vol1/ERR1_1.fastq.gz"] = content
+    chunks = []
+    with pytest.raises(ChecksumError):
+        for chunk in stream_file(fastq_file._replace(md5="0" * 32), backend=HttpsBackend(range_server.url)):
+            chunks.append(chunk)
+    assert b"".join(chunks) == content
+
+def test_stream_decompresses(range_server):
+    range_server.files["/vol1/ERR1_1.fastq.gz"] = gzip.compress(content)
+    data = b"".join(stream_file(FastqFile(fastq_file.url), decompress=True, backend=HttpsBackend(range_server.url)))
+    assert data == content
+
+def test_files_of_a_run_share_the_rate(range_server):
+    received = {}
+    for name in ["ERR1_1", "ERR1_2"]:
+        range_server.files[f"/vol1/{name}.fastq.gz"] = content
+
+    def target(run, fastq_file, chunk):
+        received[fastq_file.filename] = received.get(fastq_file.filename, b"") + chunk
+
+    backend = DroppingBackend(range_server.url)
+    files = ["ftp.sra.ebi.ac.uk/vol1/ERR1_1.fastq.gz", "ftp.sra.ebi.ac.uk/vol1/ERR1_2.fastq.gz"]
+    stream_data("ERR1", files, target, backend=backend, rate=100000)
+    assert backend.rates == [50000, 50000]
+    assert received == {"ERR1_1.fastq.gz": content, "ERR1_2.fastq.gz": content}
+
+@pytest.mark.parametrize("option", [["--transfers", "4"], ["--segments", "4"], ["--progress"], ["--adaptive"], ["--report", "report.json"], ["--journal", "journal.jsonl"]])
+def test_cli_rejects_options_that_do_not_apply_to_streaming(option, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", ["ena-download", "ERR1000001", "--stream-to", "-"] + option)
+    with pytest.raises(SystemExit) as error:
+        cli()
+    assert error.value.code == 2
+    assert os.listdir(str(tmp_path)) == []
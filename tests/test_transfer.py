@@ -0,0 +1,54 @@
+import os
+import threading
+import time
+
+import pytest
+
+from ena_download import FastqFile, HttpsBackend, TransferBackend, TransferCancelled, TransferScheduler, download_file
+
+content = os.urandom(300 * 1024)
+fastq_file = FastqFile("ftp.sra.ebi.ac.uk/vol1/ERR1_1.fastq.gz", "", len(content))
+
+def test_transfer_backend_is_abstract():
+    with pytest.raises(TypeError):
+        TransferBackend()
+
+def test_https_resumes_partial_file(range_server, tmp_path):
+    range_server.files["/vol1/ERR1_1.fastq.gz"] = content
+    filename = str(tmp_path / "ERR1_1.fastq.gz")
+    with open(filename, "wb") as f:
+        f.write(content[:1000])
+    HttpsBackend(range_server.url).transfer(fastq_file, filename)
+    assert range_server.ranges == ["bytes=1000-"]
+    assert open(filename, "rb").read() == content
+
+def test_https_complete_file_of_unknown_size(range_server, tmp_path):
+    range_server.files["/vol1/ERR1_1.fastq.gz"] = content
+    filename = str(tmp_path / "ERR1_1.fastq.gz")
+    with open(filename, "wb") as f:
+        f.write(content)
+    HttpsBackend(range_server.url).transfer(FastqFile(fastq_file.url), filename)
+    assert range_server.ranges == [f"bytes={len(content)}-"]
+    assert open(filename, "rb").read() == content
+
+def test_https_restarts_without_range_support(range_server, tmp_path):
+    range_server.files["/vol1/ERR1_1.fastq.gz"] = content
+    range_server.support_ranges = False
+    filename = str(tmp_path / "ERR1_1.fastq.gz")
+    with open(filename, "wb") as f:
+        f.write(b"x" * 1000)
+    HttpsBackend(range_server.url).transfer(fastq_file, filename)
+    assert open(filename, "rb").read() == content
+
+def test_download_stops_when_cancelled(range_server, tmp_path):
+    range_server.files["/vol1/ERR1_1.fastq.gz"] = content
+    cancel = threading.Event()
+    threading.Timer(0.5, cancel.set).start()
+    # 400 kbps takes 6 seconds for the whole file
+    scheduler = TransferScheduler(max_rate=400)
+    start = time.monotonic()
+    with pytest.raises(TransferCancelled):
+        download_file(fastq_file, str(tmp_path), 30, scheduler, HttpsBackend(range_server.url, chunk_size=4096), cancel=cancel)
+    scheduler.close()
+    assert time.monotonic() - start < 3
+    assert os.path.getsize(str(tmp_path / "ERR1_1.fastq.gz")) < len(content)
@@ -0,0 +1,36 @@
+import subprocess as sp
+import time
+
+import pytest
+
+from ena_download import run_with_watchdog
+
+def test_watchdog_kills_stalled_process_group(tmp_path):
+    pid_file = str(tmp_path / "child.pid")
+    cmd = ["sh", "-c", f"sleep 60 & echo $! > {pid_file}; wait"]
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        run_with_watchdog(cmd, [str(tmp_path / "never")], timeout=1, poll_interval=0.1)
+    assert time.monotonic() - start < 10
+    child = int(open(pid_file).read())
+    # The child of the shell was killed with it; it may linger as a zombie
+    for _ in range(50):
+        try:
+            with open(f"/proc/{child}/stat") as f:
+                alive = f.read().split(") ")[1][0] != "Z"
+        except FileNotFoundError:
+            alive = False
+        if not alive:
+            break
+        time.sleep(0.1)
+    assert not alive
+
+def test_watchdog_keeps_process_that_makes_progress(tmp_path):
+    output = str(tmp_path / "out")
+    cmd = ["sh", "-c", f"for i in 1 2 3 4 5; do echo x >> {output}; sleep 0.4; done"]
+    run_with_watchdog(cmd, [output], timeout=1, poll_interval=0.1)
+    assert open(output).read() == "x\n" * 5
+
+def test_watchdog_raises_on_failure(tmp_path):
+    with pytest.raises(sp.CalledProcessError):
+        run_with_watchdog(["sh", "-c", "exit 3"], [], timeout=5, poll_interval=0.1)
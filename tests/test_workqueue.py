@@ -0,0 +1,69 @@
+import sqlite3
+import time
+
+from ena_download.workqueue import DONE, FAILED, LEASED, WorkQueue
+
+files = {"ERR1": [{"url": "a", "md5": "x", "bytes": 1}]}
+
+def test_expired_lease_is_handed_to_another_worker(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    first = WorkQueue(path, lease_seconds=0.2, worker="first")
+    second = WorkQueue(path, lease_seconds=0.2, worker="second")
+    first.add(files)
+
+    task = first.lease()
+    assert task is not None and task.attempts == 1
+    assert second.lease() is None
+    time.sleep(0.3)
+    again = second.lease()
+    assert again is not None
+    assert (again.id, again.attempts) == (task.id, 2)
+
+    # The first worker no longer holds the task
+    assert not first.renew(task)
+    assert not first.ack(task)
+    assert second.ack(again)
+    assert second.counts()[DONE] == 1
+    first.close()
+    second.close()
+
+def test_renewed_lease_does_not_expire(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    first = WorkQueue(path, lease_seconds=0.3, worker="first")
+    second = WorkQueue(path, lease_seconds=0.3, worker="second")
+    first.add(files)
+    task = first.lease()
+    with first.hold(task) as lost:
+        time.sleep(0.6)
+        assert second.lease() is None
+    assert not lost.is_set()
+    assert first.ack(task)
+    first.close()
+    second.close()
+
+def test_lease_expires_after_last_attempt(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), lease_seconds=0.1, max_attempts=2)
+    queue.add(files)
+    assert queue.lease().attempts == 1
+    time.sleep(0.2)
+    assert queue.lease().attempts == 2
+    time.sleep(0.2)
+    assert queue.lease() is None
+    assert queue.counts()[FAILED] == 1
+    assert [error for _, error in queue.failures()] == ["lease expired"]
+    queue.close()
+
+def test_hold_reports_lost_lease(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    queue = WorkQueue(path, lease_seconds=0.3, worker="first")
+    queue.add(files)
+    task = queue.lease()
+    with queue.hold(task) as lost:
+        # Another worker took the task over
+        conn = sqlite3.connect(path)
+        conn.execute("UPDATE tasks SET worker = 'second', attempts = attempts + 1 WHERE state = ?", (LEASED,))
+        conn.commit()
+        conn.close()
+        assert lost.wait(2)
+    assert not queue.ack(task)
+    queue.close()